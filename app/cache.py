@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, NamedTuple, Optional, Set, Tuple
+from uuid import uuid4
+import orjson
+from fastapi import Response
+from database.database import engine, read_engine
+from websocket.broker import Broker, RedisBroker, UnixSocketBroker
+from config import CACHE_TTL, CACHE_MAX_ENTRIES, CACHE_INVALIDATION, CACHE_IPC_PATH, CACHE_REPLICA_LAG, WS_REDIS_URL
+
+# The broker "room" invalidations are published to
+INVALIDATION_CHANNEL = "invalidate"
+
+
+class CachedPayload(NamedTuple):
+    body: bytes
+    etag: str
+    tags: Tuple[str, ...]
+    expires: float
+
+
+# load(primary) returns (payload, tags, etag) or None when there is nothing to cache (e.g. not found).
+# It reads from the replica unless primary is set
+Loader = Callable[[bool], Optional[Tuple[Any, Iterable[str], Optional[str]]]]
+
+
+def strong_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = {tag.strip() for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
+class PayloadCache:
+    """
+    Read-through cache of serialized GET payloads (single cases and simulations),
+    TTL + LRU. Every entry is tagged with the rows it was built from ("case:3",
+    "sim:7"), the write routes invalidate those tags. The TTL bounds how stale another
+    worker's copy can get, unless CACHE_INVALIDATION shares the invalidations over a broker.
+    A load from the replica that covers a row invalidated less than replica_lag seconds
+    ago is done again on the primary, the replica may not have the write yet.
+    Route handlers run in the threadpool, so everything here is behind one lock.
+    """
+    def __init__(
+        self,
+        ttl: float = CACHE_TTL,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        broker: Optional[Broker] = None,
+        replica_lag: float = CACHE_REPLICA_LAG if read_engine is not engine else 0,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.replica_lag = replica_lag
+        # tag -> when it was last invalidated, only the ones within replica_lag
+        self.invalidated: Dict[str, float] = {}
+        self.entries: "OrderedDict[Any, CachedPayload]" = OrderedDict()
+        self.tagged: Dict[str, Set[Any]] = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "primary_reloads": 0}
+        # Bumped by every invalidation, a load that raced one isn't stored
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.broker = broker
+        self.worker_id = uuid4().hex
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self):
+        if self.broker is None:
+            return
+        self.loop = asyncio.get_running_loop()
+        await self.broker.start(self._on_invalidation)
+        await self.broker.subscribe(INVALIDATION_CHANNEL)
+
+    async def stop(self):
+        if self.broker is not None:
+            await self.broker.stop()
+
+    def get_or_load(self, key: Any, load: Loader) -> Optional[CachedPayload]:
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires > now:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry
+            self.stats["misses"] += 1
+            generation = self.generation
+
+        loaded = load(False)
+        if loaded is not None and self._recently_invalidated(loaded[1]):
+            loaded = load(True)
+            with self.lock:
+                self.stats["primary_reloads"] += 1
+        if loaded is None:
+            return None
+
+        payload, tags, etag = loaded
+        body = orjson.dumps(payload)
+        entry = CachedPayload(body, etag or strong_etag(body), tuple(tags), now + self.ttl)
+
+        with self.lock:
+            if generation == self.generation:
+                self._store(key, entry)
+        return entry
+
+    def _recently_invalidated(self, tags: Iterable[str]) -> bool:
+        if not self.replica_lag:
+            return False
+        since = time.monotonic() - self.replica_lag
+        with self.lock:
+            return any(self.invalidated.get(tag, since) > since for tag in tags)
+
+    def _store(self, key: Any, entry: CachedPayload):
+        self._remove(key)
+        self.entries[key] = entry
+        for tag in entry.tags:
+            self.tagged.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+
+    def _remove(self, key: Any):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry.tags:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged[tag]
+
+    def invalidate(self, *tags: str, broadcast: bool = True):
+        """Drop every entry built from these rows, on the other workers too when a broker is set."""
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self.tagged.get(tag, ())):
+                    self._remove(key)
+            self.stats["invalidations"] += 1
+
+            if self.replica_lag:
+                now = time.monotonic()
+                self.invalidated = {tag: at for tag, at in self.invalidated.items() if now - at < self.replica_lag}
+                self.invalidated.update(dict.fromkeys(tags, now))
+
+        if broadcast and self.broker is not None and self.loop is not None:
+            message = {"origin": self.worker_id, "tags": list(tags)}
+            # Called from the threadpool, the broker lives on the event loop
+            asyncio.run_coroutine_threadsafe(self.broker.publish(INVALIDATION_CHANNEL, message), self.loop)
+
+    async def _on_invalidation(self, channel: str, message: Dict[str, Any]):
+        if message.get("origin") != self.worker_id:
+            self.invalidate(*message.get("tags", ()), broadcast=False)
+
+    def response(self, entry: CachedPayload, if_none_match: Optional[str]) -> Response:
+        """The cached body, or 304 when the client already has this version."""
+        headers = {"ETag": entry.etag}
+        if _etag_matches(if_none_match, entry.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=entry.body, media_type="application/json", headers=headers)
+
+    def status(self) -> dict:
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_ratio": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "invalidation": CACHE_INVALIDATION or "local",
+            }
+
+
+def _create_invalidation_broker(kind: str = CACHE_INVALIDATION) -> Optional[Broker]:
+    """CACHE_INVALIDATION: "" (default, this worker only), "ipc" or "redis"."""
+    if kind == "ipc":
+        return UnixSocketBroker(CACHE_IPC_PATH)
+    if kind == "redis":
+        return RedisBroker(WS_REDIS_URL, prefix="beds2bytes:cache:")
+    return None
+
+
+payload_cache = PayloadCache(broker=_create_invalidation_broker())
@@ -1,8 +1,93 @@
 from pathlib import Path
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
 
 # Base directory of the app (folder where main.py lives)
 BASE_DIR = Path(__file__).resolve().parent
 
 # uploads/ folder next to main.py
 UPLOAD_DIR = BASE_DIR / "uploads"
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
+UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+
+# Websocket outbound queue size per connection (the high-water mark for slow clients)
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "64"))
+# What to do when a client's queue is full: "drop" the oldest queued update a newer one carries the same ids again
+# (disconnecting with 1013 when no queued frame is superseded like that) or "disconnect" the client
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop")
+
+# Room pub/sub between workers: "memory" (single process), "ipc" (workers on one host) or "redis"
+WS_BROKER = os.getenv("WS_BROKER", "memory")
+WS_IPC_PATH = os.getenv("WS_IPC_PATH", "/tmp/beds2bytes-ws.sock")
+WS_REDIS_URL = os.getenv("WS_REDIS_URL", "redis://localhost:6379/0")
+# Seconds a broker reply or write may take before the connection (or a slow IPC peer) is dropped and reconnected
+WS_BROKER_TIMEOUT = float(os.getenv("WS_BROKER_TIMEOUT", "5"))
+
+# Coalesce vital updates and flush them at most this many times per second per room, 0 sends every update
+WS_TICK_HZ = float(os.getenv("WS_TICK_HZ", "0"))
+
+# Recent broadcasts kept per room so reconnecting clients can catch up with last_seq
+WS_HISTORY_SIZE = int(os.getenv("WS_HISTORY_SIZE", "256"))
+# Seconds a room's live vitals are kept after its last user left (on the worker, and on the IPC hub), a rejoin picks them up again
+WS_ROOM_STATE_TTL = float(os.getenv("WS_ROOM_STATE_TTL", "600"))
+
+# How often the server side trend engine steps the vitals of every room, per second
+WS_TREND_HZ = float(os.getenv("WS_TREND_HZ", "2"))
+
+# Simulation event log, events are written in batches of this size or every interval (seconds)
+EVENT_LOG_BATCH_SIZE = int(os.getenv("EVENT_LOG_BATCH_SIZE", "500"))
+EVENT_LOG_FLUSH_INTERVAL = float(os.getenv("EVENT_LOG_FLUSH_INTERVAL", "1.0"))
+
+# Seconds a cached /ws room admission (simulation state and passphrase) is trusted before re-checking the database
+WS_ADMISSION_TTL = float(os.getenv("WS_ADMISSION_TTL", "60"))
+# Unknown simulation ids are remembered for a shorter while, and the cache holds at most this many simulations
+WS_ADMISSION_NEGATIVE_TTL = float(os.getenv("WS_ADMISSION_NEGATIVE_TTL", "5"))
+WS_ADMISSION_MAX_ENTRIES = int(os.getenv("WS_ADMISSION_MAX_ENTRIES", "10000"))
+
+# Threads for the sync route handlers (all database work runs there, off the event loop)
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+# Cache of single case/simulation GET payloads, entries live this many seconds at most
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+# Share cache invalidations between workers: "" (this worker only, others wait out the TTL), "ipc" or "redis" (WS_REDIS_URL)
+CACHE_INVALIDATION = os.getenv("CACHE_INVALIDATION", "")
+CACHE_IPC_PATH = os.getenv("CACHE_IPC_PATH", "/tmp/beds2bytes-cache.sock")
+# With DB_READ_URL, rows invalidated this many seconds ago are reloaded from the primary, the replica may lag behind
+CACHE_REPLICA_LAG = float(os.getenv("CACHE_REPLICA_LAG", "5"))
+
+# Argon2 password hash cost, changing these rehashes each user's password on their next login
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "3"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "65536"))  # KiB
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", "4"))
+# Threads hashing passwords, and how many hash/verify calls may be running or waiting before logins get a 503.
+# Keep PASSWORD_MAX_PENDING below THREADPOOL_SIZE, every waiting call holds a route thread
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(os.cpu_count() or 2)))
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", "16"))
+
+# Verified JWTs kept per worker, so a returning token costs a lookup instead of a decode and HMAC check
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "4096"))
+
+# Access tokens are short lived and renewed with a refresh token (POST /users/refresh), which rotates on every use
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "14"))
+# Seconds between each worker's check for tokens revoked on other workers
+REVOCATION_SYNC_INTERVAL = float(os.getenv("REVOCATION_SYNC_INTERVAL", "5"))
+
+# Per client token buckets, "<requests>/<seconds>" (the bucket holds <requests>, refilled over <seconds>), empty turns a limit off.
+# Login counts per IP and email, against password guessing, with a per IP ceiling roomy enough for a whole class
+# logging in from one school address. Register and refresh count per IP.
+# Writes (POST/PUT/PATCH/DELETE) count per user, per IP without a valid token
+RATE_LIMIT_LOGIN = os.getenv("RATE_LIMIT_LOGIN", "10/60")
+RATE_LIMIT_LOGIN_IP = os.getenv("RATE_LIMIT_LOGIN_IP", "1000/60")
+RATE_LIMIT_REGISTER = os.getenv("RATE_LIMIT_REGISTER", "20/60")
+RATE_LIMIT_REFRESH = os.getenv("RATE_LIMIT_REFRESH", "60/60")
+RATE_LIMIT_WRITES = os.getenv("RATE_LIMIT_WRITES", "120/60")
+# Where the buckets live: "" (each worker on its own) or "redis" (WS_REDIS_URL, shared by every worker)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Connections each worker opens to Redis for the buckets, concurrent requests don't wait on one round trip at a time
+RATE_LIMIT_REDIS_CONNECTIONS = int(os.getenv("RATE_LIMIT_REDIS_CONNECTIONS", "8"))
+# HTTP requests one worker works on at once, the rest get a 503 right away instead of queueing for the database. 0 turns it off
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "64"))
@@ -0,0 +1,232 @@
+import re
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, Type
+import orjson
+from fastapi import HTTPException, Request
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from .database import SessionLocal
+
+# Rows validated and inserted per round trip
+BULK_BATCH_SIZE = 1000
+# Only this many row errors are sent back, the count covers all of them
+MAX_REPORTED_ERRORS = 100
+
+# (row number, raw NDJSON line or JSON array item)
+Row = Tuple[int, bytes]
+# check(db, [(row number, insert values), ...]) -> {row number: why it was rejected}
+Check = Callable[[Session, List[Tuple[int, Dict[str, Any]]]], Dict[int, str]]
+
+# What changes the nesting outside a string, and what ends (or escapes inside) one
+_STRUCTURE = re.compile(rb'[\[\]{}",]')
+_STRING_END = re.compile(rb'["\\]')
+
+
+def _not_json():
+    return HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+
+
+async def _iter_json_array(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    The raw items of a JSON array, cut out as the body streams in so it is never held
+    whole. Only the array itself is checked here, each item is parsed by the model.
+    """
+    buffer = b""
+    pos = 0  # Scanned up to here
+    start = 0  # Where the current item starts
+    depth = 0
+    in_string = False
+    done = False
+
+    async for chunk in chunks:
+        if done:
+            if chunk.strip():
+                raise _not_json()
+            continue
+        buffer += chunk
+        while not done:
+            if in_string:
+                match = _STRING_END.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer)
+                    break
+                if match.group() == b"\\":
+                    if match.end() >= len(buffer):
+                        # The escaped byte is in the next chunk
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                in_string = False
+                pos = match.end()
+                continue
+
+            match = _STRUCTURE.search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+            token = match.group()
+            pos = match.end()
+            if depth == 0 and (token != b"[" or buffer[:match.start()].strip()):
+                raise _not_json()
+
+            if token == b'"':
+                in_string = True
+            elif token in (b"[", b"{"):
+                depth += 1
+                if depth == 1:
+                    start = pos
+            elif token in (b"]", b"}"):
+                depth -= 1
+                if depth == 0:
+                    item = buffer[start:match.start()]
+                    if item.strip():
+                        yield item
+                    if buffer[pos:].strip():
+                        raise _not_json()
+                    done = True
+            elif depth == 1:
+                # The comma between two items
+                yield buffer[start:match.start()]
+                start = pos
+
+        if not done and depth:
+            # Forget what has been handed out already
+            buffer = buffer[start:]
+            pos -= start
+            start = 0
+
+    if not done:
+        raise _not_json()
+
+
+async def iter_rows(request: Request) -> AsyncIterator[Row]:
+    """
+    The rows of an import body, read as it streams in: NDJSON line by line, or the
+    items of a JSON array (Content-Type: application/json).
+    """
+    content_type = request.headers.get("content-type", "")
+    if "json" in content_type and "ndjson" not in content_type:
+        number = 0
+        async for item in _iter_json_array(request.stream()):
+            number += 1
+            yield number, item
+        return
+
+    buffer = b""
+    number = 0
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield number, line
+    if buffer.strip():
+        yield number + 1, buffer
+
+
+def _row_errors(error: ValidationError) -> List[Dict[str, Any]]:
+    return [{"loc": list(e["loc"]), "msg": e["msg"]} for e in error.errors()]
+
+
+def _db_error(error: DBAPIError) -> str:
+    # The driver's message without the statement and parameters SQLAlchemy appends
+    return str(error.orig).strip().splitlines()[0] if error.orig is not None else "Database error"
+
+
+async def bulk_import(
+    request: Request,
+    model: Type[BaseModel],
+    build_row: Callable[[BaseModel], Dict[str, Any]],
+    table,
+    check: Optional[Check] = None,
+    atomic: bool = False,
+) -> Dict[str, Any]:
+    """
+    Insert every row of an NDJSON / JSON array body into table in one transaction.
+    Rows are validated against model BULK_BATCH_SIZE at a time, and each batch is
+    inserted with a single executemany under its own SAVEPOINT, all in the threadpool.
+    Invalid rows, and rows check or the database rejects, are skipped and reported by
+    row number. With atomic=True any of them rolls the whole import back. The session
+    is only opened once the first batch has been read and validated, and nothing is
+    committed unless the whole body arrived.
+    """
+    summary = {"inserted": 0, "failed": 0, "committed": False, "errors": []}
+    db: Optional[Session] = None
+
+    def report(number: int, errors: List[Dict[str, Any]]):
+        summary["failed"] += 1
+        if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+            summary["errors"].append({"row": number, "errors": errors})
+
+    def insert_rows(rows: List[Tuple[int, Dict[str, Any]]]):
+        rejected = check(db, rows) if check and rows else {}
+        for number, reason in rejected.items():
+            report(number, [{"loc": [], "msg": reason}])
+
+        rows = [(number, row) for number, row in rows if number not in rejected]
+        if not rows:
+            return
+        try:
+            with db.begin_nested():
+                db.execute(insert(table), [row for _, row in rows])
+            summary["inserted"] += len(rows)
+            return
+        except DBAPIError:
+            pass
+
+        # One bad row (a constraint, a value out of range) fails the whole executemany, find it
+        for number, row in rows:
+            try:
+                with db.begin_nested():
+                    db.execute(insert(table), [row])
+                summary["inserted"] += 1
+            except DBAPIError as e:
+                report(number, [{"loc": [], "msg": _db_error(e)}])
+
+    def write(batch: List[Row]):
+        nonlocal db
+        rows = []
+        for number, raw in batch:
+            try:
+                data = model.model_validate_json(raw)
+            except ValidationError as e:
+                report(number, _row_errors(e))
+                continue
+            rows.append((number, build_row(data)))
+
+        if atomic and summary["failed"]:
+            # Nothing will be kept, only the errors are still collected
+            return
+        if rows and db is None:
+            db = SessionLocal()
+        if rows:
+            insert_rows(rows)
+
+    try:
+        batch: List[Row] = []
+        async for row in iter_rows(request):
+            batch.append(row)
+            if len(batch) >= BULK_BATCH_SIZE:
+                await run_in_threadpool(write, batch)
+                batch = []
+        if batch:
+            await run_in_threadpool(write, batch)
+
+        if atomic and summary["failed"]:
+            if db is not None:
+                await run_in_threadpool(db.rollback)
+            summary["inserted"] = 0
+        else:
+            if db is not None:
+                await run_in_threadpool(db.commit)
+            summary["committed"] = True
+    finally:
+        # Rolls back whatever wasn't committed, e.g. when the client disconnects mid-upload
+        if db is not None:
+            await run_in_threadpool(db.close)
+
+    return summary
@@ -1,15 +1,27 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Text, Boolean
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Text, Boolean, Index, Computed
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 from sqlalchemy.ext.mutable import MutableDict
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, deferred
 from .database import Base
 
+# Text search configuration of search_vector, "simple" doesn't stem so Finnish and English both work.
+# The column is generated with it (migration 0005), changing it needs a new migration
+SEARCH_CONFIG = "simple"
+
+# The weighted document /cases/search matches against, A ranks highest
+SEARCH_VECTOR = (
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(case_name, '') || ' ' || coalesce(base_problem, '')), 'A') || "
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(learning_goals, '') || ' ' || coalesce(start_point, '')), 'B') || "
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(ai_summary, '')), 'C') || "
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(medication_list, '') || ' ' || coalesce(lab_samples, '')), 'D')"
+)
+
 # Cases Item Model
 class CaseItem(Base):
     __tablename__ = "cases"
  
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
 
     case_name = Column(String, nullable=False)
     patient_name = Column(String, nullable=False)
@@ -24,6 +36,18 @@ class CaseItem(Base):
     ai_summary = Column(Text, nullable=False)
     medication_list = Column(Text, nullable=False)
     lab_samples = Column(Text, nullable=False)
+    # Bumped on every update, sent as the ETag for If-Match
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    # Generated by Postgres from the texts above, so it is current after every insert and update.
+    # Deferred, it's only for searching and never part of a response
+    search_vector = deferred(Column(TSVECTOR, Computed(SEARCH_VECTOR, persisted=True)))
+
+    __table_args__ = (
+        # Containment, key existence and equality JSON path queries over base_values (/cases/query).
+        # jsonb_ops, not jsonb_path_ops, which can't answer the key existence operators
+        Index("ix_cases_base_values", "base_values", postgresql_using="gin"),
+        Index("ix_cases_search_vector", "search_vector", postgresql_using="gin"),
+    )
 
     simulations = relationship("SimulationItem", back_populates="case")
     user = relationship('UserItem', back_populates="cases")
\ No newline at end of file
@@ -1,14 +1,126 @@
 from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
-DATABASE_URL = f"postgresql://{os.getenv('DBUSER')}:{os.getenv('DBPW')}@{os.getenv('DBURL')}/{os.getenv('DBNAME')}"
+# Either the full URL in DB_URL or its parts
+DATABASE_URL = os.getenv("DB_URL") or f"postgresql://{os.getenv('DBUSER')}:{os.getenv('DBPW')}@{os.getenv('DBURL')}/{os.getenv('DBNAME')}"
+# Optional read replica, GET routes read from it when set
+DATABASE_READ_URL = os.getenv("DB_READ_URL")
 
-engine = create_engine(DATABASE_URL)
+# Connection pool, per worker process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Seconds before a connection is replaced
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))  # 0 disables it
+
+
+def _driver_url(url: str) -> str:
+    # requirements.txt ships psycopg2, newer SQLAlchemy defaults postgresql:// to psycopg 3
+    if url.startswith("postgresql://"):
+        return "postgresql+psycopg2://" + url[len("postgresql://"):]
+    return url
+
+
+# How long checkouts waited for a pooled connection, per engine
+_checkout_stats = {}
+# Sync routes check connections out from the threadpool, += on a dict value isn't atomic there
+_checkout_lock = threading.Lock()
+
+
+def _timed_pool(name: str):
+    """
+    A QueuePool that adds the time every checkout took (waiting for a free connection,
+    or opening an overflow one) to _checkout_stats[name]. Measured where the session
+    really asks for its connection, so routes that never query don't check one out.
+    """
+    stats = _checkout_stats[name] = {"checkouts": 0, "wait_total": 0.0, "wait_max": 0.0}
+
+    class TimedQueuePool(QueuePool):
+        def _do_get(self):
+            start = time.perf_counter()
+            connection = super()._do_get()
+            waited = time.perf_counter() - start
+            with _checkout_lock:
+                stats["checkouts"] += 1
+                stats["wait_total"] += waited
+                stats["wait_max"] = max(stats["wait_max"], waited)
+            return connection
+
+    return TimedQueuePool
+
+
+def _create_engine(url: str, name: str):
+    connect_args = {}
+    if DB_STATEMENT_TIMEOUT_MS:
+        connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+
+    return create_engine(
+        _driver_url(url),
+        poolclass=_timed_pool(name),
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args=connect_args,
+    )
+
+
+engine = _create_engine(DATABASE_URL, "primary")
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+if DATABASE_READ_URL:
+    read_engine = _create_engine(DATABASE_READ_URL, "replica")
+    ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+else:
+    read_engine = engine
+    ReadSessionLocal = SessionLocal
+
 Base = declarative_base()
+
+def _session(factory):
+    # The connection is only checked out once the route first uses the session
+    db = factory()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Dependency to get DB session
+def get_db():
+    yield from _session(SessionLocal)
+
+
+# Dependency for read only routes, the replica when one is configured
+def get_read_db():
+    yield from _session(ReadSessionLocal)
+
+
+def pool_status() -> dict:
+    """Pool usage and checkout wait times, for monitoring."""
+    status = {}
+    for name, e in (("primary", engine), ("replica", read_engine)):
+        if name == "replica" and e is engine:
+            continue
+        with _checkout_lock:
+            stats = dict(_checkout_stats[name])
+        status[name] = {
+            "size": e.pool.size(),
+            "checked_out": e.pool.checkedout(),
+            "overflow": e.pool.overflow(),
+            "checked_in": e.pool.checkedin(),
+            "checkouts": stats["checkouts"],
+            "wait_avg_ms": round(stats["wait_total"] / stats["checkouts"] * 1000, 3) if stats["checkouts"] else 0.0,
+            "wait_max_ms": round(stats["wait_max"] * 1000, 3),
+        }
+    return status
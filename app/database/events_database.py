@@ -0,0 +1,20 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Index
+from sqlalchemy.dialects.postgresql import JSONB
+from .database import Base
+
+# Simulation Event Model, an append-only log of everything broadcast in a room
+class SimulationEventItem(Base):
+    __tablename__ = "simulation_events"
+
+    id = Column(BigInteger, primary_key=True)
+    room_id = Column(String, nullable=False)  # The simulation id for simulation rooms
+    seq = Column(Integer, nullable=True)
+    type = Column(String, nullable=False)
+    user_id = Column(String, nullable=True)  # Who sent it, "engine" for server side trends
+    payload = Column(JSONB, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        # Replays read one room's timeline in order
+        Index("ix_simulation_events_room_created", "room_id", "created_at"),
+    )
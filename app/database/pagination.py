@@ -0,0 +1,44 @@
+from typing import Any, Callable, Optional
+import orjson
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from .database import ReadSessionLocal
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+
+def paginate(query, id_column, after: Optional[int], limit: int, response: Response) -> list:
+    """
+    Keyset pagination on id: the rows after the `after` cursor, at most `limit` of them.
+    When there are more, the cursor for the next page is sent in the X-Next-Cursor header.
+    """
+    if after is not None:
+        query = query.filter(id_column > after)
+
+    # One extra row tells whether there is a next page
+    rows = query.order_by(id_column).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = str(rows[-1].id)
+    return rows
+
+
+def stream_ndjson(build_query: Callable[[Session], Any], id_column, serialize: Callable[[Any], dict]) -> StreamingResponse:
+    """
+    Stream every row of a query as NDJSON, for exports. The rows come from a
+    server side cursor, STREAM_BATCH_SIZE at a time, so memory stays flat however big the table is.
+    """
+    def generate():
+        # Own session, the response keeps streaming after the request's dependencies are gone
+        db = ReadSessionLocal()
+        try:
+            query = build_query(db).order_by(id_column).yield_per(STREAM_BATCH_SIZE)
+            for row in query:
+                yield orjson.dumps(serialize(row)) + b"\n"
+        finally:
+            db.close()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
@@ -7,14 +7,14 @@ class SimulationItem(Base):
     __tablename__ = "simulations"
  
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)  # Associate created simulation with a user
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)  # Associate created simulation with a user
     case_id = Column(Integer, ForeignKey("cases.id"), nullable=False)
     name = Column(String, nullable=False)
     nurse_notes = Column(Text, nullable=True)
     ergo_notes = Column(Text, nullable=True)
     phys_notes = Column(Text, nullable=True)
     passphrase = Column(String, nullable=False, default="beds2bytes")
-    state = Column(Boolean, nullable=False, default=True)
+    state = Column(Boolean, nullable=False, default=True, index=True)
 
     user = relationship("UserItem", back_populates="simulations")
     case = relationship("CaseItem", back_populates="simulations")
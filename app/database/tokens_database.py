@@ -0,0 +1,27 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey
+from .database import Base
+
+# Refresh Token Model, only a hash of the token is stored
+class RefreshTokenItem(Base):
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    token_hash = Column(String, nullable=False, unique=True, index=True)
+    # Every token rotated out of the same login, reusing a rotated token revokes them all
+    family_id = Column(String, nullable=False, index=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+    revoked_at = Column(DateTime(timezone=True), nullable=True)
+
+# Token Revocation Model, an append-only log the workers keep their in-memory revocation list from.
+# A row revokes either one access token (jti) or every access token a user got before revoked_before
+class TokenRevocationItem(Base):
+    __tablename__ = "token_revocations"
+
+    id = Column(BigInteger, primary_key=True)
+    jti = Column(String, nullable=True)
+    user_id = Column(Integer, nullable=True)  # No foreign key, deleted users are revoked too
+    revoked_before = Column(DateTime(timezone=True), nullable=True)
+    # After this every token the row covers has expired on its own, the row can go
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
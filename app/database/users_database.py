@@ -8,8 +8,9 @@ class UserItem(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True, index=True)
-    username = Column(String, nullable=False)
-    email = Column(String, nullable=False)
+    # Unique indexes, registration and login look users up by these
+    username = Column(String, nullable=False, unique=True, index=True)
+    email = Column(String, nullable=False, unique=True, index=True)
     password = Column(String, nullable=False) # Hashed password
     role = Column(Enum(RoleEnum), default=RoleEnum.student, nullable=False) # I.E admin, student...
 
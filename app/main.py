@@ -6,20 +6,47 @@ from sqlalchemy.orm import Session
 from security.verify import verify_jwt_token
 from routers import simulation, users, cases, files
 from routers.files import router as file_router
-from database.database import Base, engine
+from database.database import pool_status
 from database.users_database import UserItem
 from database.simulation_database import SimulationItem
 from database.cases_database import CaseItem
 from database.files_database import FileItem
-from websocket.websocket import router as websocket_router
+from database.events_database import SimulationEventItem
+from database.tokens_database import RefreshTokenItem, TokenRevocationItem
+# The schema is managed by the migrations in migrations/, run `alembic upgrade head`
+from websocket.websocket import router as websocket_router, manager as room_manager
+from websocket.admission import admission_cache
+from cache import payload_cache
+from security.passwords import password_pool
+from security.revocation import revocation_list
+from ratelimit import RateLimitMiddleware, rate_limiter
 from pathlib import Path
-from config import UPLOAD_DIR
+from config import UPLOAD_DIR, THREADPOOL_SIZE
+from contextlib import asynccontextmanager
+import anyio
 
-# Create DB tables and such for sqlalchemy
-Base.metadata.create_all(bind=engine)
+# Start and stop the background pieces that live as long as the worker
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Routes that touch the database are plain `def`, FastAPI runs them in this threadpool
+    # so a query never blocks the event loop (and with it every websocket room)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    await admission_cache.warm()
+    await revocation_list.start()
+    await room_manager.start()
+    await payload_cache.start()
+    yield
+    await payload_cache.stop()
+    await room_manager.stop()
+    await revocation_list.stop()
+    await rate_limiter.stop()
 
 # Main App instance
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Per client rate limits and the concurrent request cap, added before CORS so CORS wraps it
+# and browsers can read the 429/503 responses too
+app.add_middleware(RateLimitMiddleware)
 
 # CORS, Allow all requests, types and headers
 app.add_middleware(
@@ -27,7 +54,9 @@ app.add_middleware(
     allow_origins=['*'],
     allow_credentials=True,
     allow_methods=['*'],
-    allow_headers=['*']
+    allow_headers=['*'],
+    # Browsers hide response headers from scripts unless they are listed here
+    expose_headers=['X-Next-Cursor', 'ETag', 'Retry-After']
 )
 
 # File directories
@@ -51,3 +80,28 @@ app.include_router(websocket_router)
 @app.get("/")
 async def root():
     return {"message": "Beds2Bytes root!!!"}
+
+# Database pool usage for monitoring
+@app.get("/health/db")
+async def db_health():
+    return pool_status()
+
+# Password hashing pool load
+@app.get("/health/passwords")
+async def passwords_health():
+    return password_pool.status()
+
+# Revoked tokens held in memory
+@app.get("/health/revocations")
+async def revocations_health():
+    return revocation_list.status()
+
+# Requests turned away by the rate limits and the concurrency cap
+@app.get("/health/ratelimit")
+async def ratelimit_health():
+    return rate_limiter.status()
+
+# Case/simulation payload cache hit rate and size
+@app.get("/health/cache")
+async def cache_health():
+    return payload_cache.status()
@@ -0,0 +1,51 @@
+import sys
+from logging.config import fileConfig
+from pathlib import Path
+from alembic import context
+from sqlalchemy import create_engine, pool
+
+# The app directory, so the models import the same way they do in main.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from database.database import Base, DATABASE_URL, _driver_url
+from database.users_database import UserItem
+from database.simulation_database import SimulationItem
+from database.cases_database import CaseItem
+from database.files_database import FileItem
+from database.events_database import SimulationEventItem
+from database.tokens_database import RefreshTokenItem, TokenRevocationItem
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+# For `alembic revision --autogenerate`
+target_metadata = Base.metadata
+
+
+def run_migrations_offline():
+    """Print the SQL instead of running it (alembic upgrade head --sql)."""
+    context.configure(
+        url=_driver_url(DATABASE_URL),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    # Not the app's engine, index builds on big tables must not hit its statement_timeout
+    connectable = create_engine(_driver_url(DATABASE_URL), poolclass=pool.NullPool)
+
+    with connectable.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
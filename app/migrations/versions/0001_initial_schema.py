@@ -0,0 +1,115 @@
+"""initial schema
+
+The tables as Base.metadata.create_all used to make them at startup. Databases
+that were created that way already have them, so each table is only created
+when it is missing and such a database just gets stamped at this revision.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _create_users():
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("username", sa.String(), nullable=False),
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("password", sa.String(), nullable=False),
+        sa.Column("role", sa.Enum("admin", "teacher", "student", name="roleenum"), nullable=False),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+
+
+def _create_cases():
+    op.create_table(
+        "cases",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("case_name", sa.String(), nullable=False),
+        sa.Column("patient_name", sa.String(), nullable=False),
+        sa.Column("patient_id", sa.String(), nullable=False),
+        sa.Column("base_values", JSONB(), nullable=False),
+        sa.Column("base_problem", sa.Text(), nullable=False),
+        sa.Column("learning_goals", sa.Text(), nullable=False),
+        sa.Column("start_point", sa.Text(), nullable=False),
+        sa.Column("ai_summary", sa.Text(), nullable=False),
+        sa.Column("medication_list", sa.Text(), nullable=False),
+        sa.Column("lab_samples", sa.Text(), nullable=False),
+    )
+    op.create_index("ix_cases_id", "cases", ["id"])
+
+
+def _create_simulations():
+    op.create_table(
+        "simulations",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("case_id", sa.Integer(), sa.ForeignKey("cases.id"), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("nurse_notes", sa.Text(), nullable=True),
+        sa.Column("ergo_notes", sa.Text(), nullable=True),
+        sa.Column("phys_notes", sa.Text(), nullable=True),
+        sa.Column("passphrase", sa.String(), nullable=False),
+        sa.Column("state", sa.Boolean(), nullable=False),
+    )
+    op.create_index("ix_simulations_id", "simulations", ["id"])
+
+
+def _create_files():
+    op.create_table(
+        "files",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("simulation_id", sa.Integer(), sa.ForeignKey("simulations.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("file_name", sa.String(), nullable=False),
+        sa.Column("file_path", sa.String(), nullable=False),
+    )
+    op.create_index("ix_files_id", "files", ["id"])
+
+
+def _create_simulation_events():
+    op.create_table(
+        "simulation_events",
+        sa.Column("id", sa.BigInteger(), primary_key=True),
+        sa.Column("room_id", sa.String(), nullable=False),
+        sa.Column("seq", sa.Integer(), nullable=True),
+        sa.Column("type", sa.String(), nullable=False),
+        sa.Column("user_id", sa.String(), nullable=True),
+        sa.Column("payload", JSONB(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+    )
+    op.create_index("ix_simulation_events_room_created", "simulation_events", ["room_id", "created_at"])
+
+
+# In foreign key order
+TABLES = (
+    ("users", _create_users),
+    ("cases", _create_cases),
+    ("simulations", _create_simulations),
+    ("files", _create_files),
+    ("simulation_events", _create_simulation_events),
+)
+
+
+def upgrade():
+    # Offline (--sql) there's no database to look at, the script creates everything
+    existing = set() if op.get_context().as_sql else set(sa.inspect(op.get_bind()).get_table_names())
+    for name, create in TABLES:
+        if name not in existing:
+            create()
+
+
+def downgrade():
+    for name, _ in reversed(TABLES):
+        op.drop_table(name)
+    sa.Enum(name="roleenum").drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,39 @@
+"""lookup indexes
+
+Unique indexes on users.email and users.username, registration and login used to
+scan the users table. Plain indexes on the foreign keys the per-user and
+per-simulation listings filter by (PostgreSQL doesn't index those on its own)
+and on simulations.state for the active simulation list.
+
+Duplicate emails or usernames already in the table make this fail, they have
+to be cleaned up first.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ("ix_users_email", "users", ["email"], True),
+    ("ix_users_username", "users", ["username"], True),
+    ("ix_simulations_user_id", "simulations", ["user_id"], False),
+    ("ix_simulations_state", "simulations", ["state"], False),
+    ("ix_cases_user_id", "cases", ["user_id"], False),
+    ("ix_files_simulation_id", "files", ["simulation_id"], False),
+)
+
+
+def upgrade():
+    for name, table, columns, unique in INDEXES:
+        op.create_index(name, table, columns, unique=unique)
+
+
+def downgrade():
+    for name, table, _, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,42 @@
+"""case merge function and version
+
+jsonb_deep_merge(dst, src) merges src into dst the way the old Python deep_merge
+did: objects are merged key by key, anything else in src replaces what was in dst.
+PATCH /cases/{id} uses it so the merge happens inside a single UPDATE.
+
+cases.version counts the updates, clients can send it back in If-Match to only
+update the version they read.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION jsonb_deep_merge(dst jsonb, src jsonb) RETURNS jsonb AS $$
+        BEGIN
+            IF jsonb_typeof(dst) IS DISTINCT FROM 'object' OR jsonb_typeof(src) IS DISTINCT FROM 'object' THEN
+                RETURN src;
+            END IF;
+            RETURN dst || coalesce(
+                (SELECT jsonb_object_agg(key, jsonb_deep_merge(dst -> key, value)) FROM jsonb_each(src)),
+                '{}'::jsonb
+            );
+        END;
+        $$ LANGUAGE plpgsql IMMUTABLE
+    """)
+    op.add_column("cases", sa.Column("version", sa.Integer(), nullable=False, server_default="1"))
+
+
+def downgrade():
+    op.drop_column("cases", "version")
+    op.execute("DROP FUNCTION IF EXISTS jsonb_deep_merge(jsonb, jsonb)")
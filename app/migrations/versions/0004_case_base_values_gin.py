@@ -0,0 +1,30 @@
+"""case base_values GIN index
+
+A jsonb_path_ops GIN index on cases.base_values for /cases/query. It answers
+containment (@>) and equality-only JSON path (@@, @?) predicates without a full
+table scan. 0007 replaces it with jsonb_ops for the key existence operators.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_cases_base_values",
+        "cases",
+        ["base_values"],
+        postgresql_using="gin",
+        postgresql_ops={"base_values": "jsonb_path_ops"},
+    )
+
+
+def downgrade():
+    op.drop_index("ix_cases_base_values", table_name="cases")
@@ -0,0 +1,33 @@
+"""case search vector
+
+A stored generated tsvector over the case texts, weighted case_name/base_problem (A),
+learning_goals/start_point (B), ai_summary (C) and medication_list/lab_samples (D),
+with a GIN index for /cases/search. Postgres fills it on every insert and update.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+        ALTER TABLE cases ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(case_name, '') || ' ' || coalesce(base_problem, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(learning_goals, '') || ' ' || coalesce(start_point, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(ai_summary, '')), 'C') ||
+            setweight(to_tsvector('simple', coalesce(medication_list, '') || ' ' || coalesce(lab_samples, '')), 'D')
+        ) STORED
+    """)
+    op.create_index("ix_cases_search_vector", "cases", ["search_vector"], postgresql_using="gin")
+
+
+def downgrade():
+    op.drop_index("ix_cases_search_vector", table_name="cases")
+    op.drop_column("cases", "search_vector")
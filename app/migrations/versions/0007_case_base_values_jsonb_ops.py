@@ -0,0 +1,33 @@
+"""case base_values GIN index with jsonb_ops
+
+Rebuilds ix_cases_base_values with the default jsonb_ops operator class instead of
+jsonb_path_ops. jsonb_path_ops only serves @> and equality JSON paths, jsonb_ops
+also serves the key existence operators (?, ?&) /cases/query uses for keys.
+Range and other non-equality JSON path predicates can't use either class.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index("ix_cases_base_values", table_name="cases")
+    op.create_index("ix_cases_base_values", "cases", ["base_values"], postgresql_using="gin")
+
+
+def downgrade():
+    op.drop_index("ix_cases_base_values", table_name="cases")
+    op.create_index(
+        "ix_cases_base_values",
+        "cases",
+        ["base_values"],
+        postgresql_using="gin",
+        postgresql_ops={"base_values": "jsonb_path_ops"},
+    )
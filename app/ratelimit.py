@@ -0,0 +1,353 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+import orjson
+from fastapi import HTTPException
+from starlette.types import ASGIApp, Receive, Scope, Send
+from websocket.broker import BrokerError, _command, _read_reply
+from security.verify import decode_token
+from config import (
+    RATE_LIMIT_LOGIN, RATE_LIMIT_LOGIN_IP, RATE_LIMIT_REGISTER, RATE_LIMIT_REFRESH, RATE_LIMIT_WRITES,
+    RATE_LIMIT_BACKEND, RATE_LIMIT_MAX_KEYS, RATE_LIMIT_REDIS_CONNECTIONS, MAX_CONCURRENT_REQUESTS,
+    WS_REDIS_URL, WS_BROKER_TIMEOUT,
+)
+
+WRITE_METHODS = frozenset({"POST", "PUT", "PATCH", "DELETE"})
+# Never limited, so monitoring still answers while the worker is saturated
+EXEMPT_PREFIXES = ("/health",)
+# Largest body read to find the account an "account" rule is keyed by, bigger ones count per IP only
+MAX_ACCOUNT_BODY = 16 * 1024
+
+
+class Budget(NamedTuple):
+    capacity: float  # Burst size
+    rate: float  # Tokens refilled per second
+
+
+def parse_budget(spec: str) -> Optional[Budget]:
+    """"<requests>/<seconds>" -> Budget, None for an empty spec (no limit)."""
+    if not spec:
+        return None
+    requests, seconds = spec.split("/")
+    return Budget(float(requests), float(requests) / float(seconds))
+
+
+class Rule(NamedTuple):
+    name: str
+    methods: FrozenSet[str]
+    paths: Optional[FrozenSet[str]]  # None for every path
+    # "ip", "user" (the token's sub when there is a valid one, IP otherwise)
+    # or "account" (IP and the email in the JSON body)
+    key: str
+    budget: Optional[Budget]
+    # A looser bucket per IP alone, on top of budget
+    ip_budget: Optional[Budget] = None
+
+
+# First match wins
+RULES: List[Rule] = [
+    Rule("login", frozenset({"POST"}), frozenset({"/users/login"}), "account", parse_budget(RATE_LIMIT_LOGIN), parse_budget(RATE_LIMIT_LOGIN_IP)),
+    Rule("register", frozenset({"POST"}), frozenset({"/users", "/users/"}), "ip", parse_budget(RATE_LIMIT_REGISTER)),
+    Rule("refresh", frozenset({"POST"}), frozenset({"/users/refresh"}), "ip", parse_budget(RATE_LIMIT_REFRESH)),
+    Rule("writes", WRITE_METHODS, None, "user", parse_budget(RATE_LIMIT_WRITES)),
+]
+
+
+class MemoryStore:
+    """
+    Token buckets of this worker, LRU bound to max_keys. Only touched from the
+    event loop, so no lock. A bucket that dropped out was (nearly) full anyway.
+    """
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take(self, key: str, budget: Budget) -> float:
+        """Takes one token, returns 0 when there was one, otherwise the seconds until there is."""
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (budget.capacity, now))
+        tokens = min(budget.capacity, tokens + (now - updated) * budget.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / budget.rate
+        self.buckets[key] = (tokens, now)
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return wait
+
+    async def stop(self):
+        pass
+
+    def status(self) -> dict:
+        return {"backend": "memory", "keys": len(self.buckets), "max_keys": self.max_keys}
+
+
+# Refills and takes from the bucket in one atomic step, timed by the Redis clock so every host agrees
+_TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return tostring(wait)
+"""
+
+
+class RedisStore:
+    """
+    Token buckets shared by every worker, in Redis (speaking RESP like RedisBroker).
+    Up to max_connections EVALs run at once, each on its own pooled connection.
+    While Redis can't be reached each worker falls back to its own buckets, so
+    the limits loosen by the number of workers instead of turning off.
+    """
+    def __init__(
+        self,
+        url: str = WS_REDIS_URL,
+        prefix: str = "beds2bytes:ratelimit:",
+        timeout: float = WS_BROKER_TIMEOUT,
+        max_connections: int = RATE_LIMIT_REDIS_CONNECTIONS,
+    ):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.username = parsed.username
+        self.password = parsed.password
+        self.prefix = prefix
+        # A Redis that stopped answering would otherwise hold the lock, and every limited request, forever
+        self.timeout = timeout
+        self.fallback = MemoryStore()
+        self.errors = 0
+        # After a failure Redis is left alone for a second, requests don't queue up on connect attempts
+        self.retry_at = 0.0
+        self.max_connections = max_connections
+        # Open connections nobody is using right now, the semaphore caps how many exist
+        self._idle: List[tuple] = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def _open(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        if self.password:
+            auth = [self.username, self.password] if self.username else [self.password]
+            writer.write(_command("AUTH", *auth))
+            await asyncio.wait_for(_read_reply(reader), self.timeout)
+        return reader, writer
+
+    async def take(self, key: str, budget: Budget) -> float:
+        if time.monotonic() < self.retry_at:
+            return await self.fallback.take(key, budget)
+        async with self._slots:
+            conn = None
+            try:
+                conn = self._idle.pop() if self._idle else await self._open()
+                reader, writer = conn
+                writer.write(_command(
+                    "EVAL", _TAKE_SCRIPT, "1", self.prefix + key,
+                    repr(budget.capacity), repr(budget.rate),
+                ))
+                wait = float(await asyncio.wait_for(_read_reply(reader), self.timeout))
+                self._idle.append(conn)
+                return wait
+            except (OSError, ConnectionError, BrokerError, asyncio.TimeoutError) as e:
+                self.errors += 1
+                print(f"Redis rate limit store failed: {type(e).__name__} {e}")
+                if conn is not None:
+                    conn[1].close()
+                self.retry_at = time.monotonic() + 1
+        return await self.fallback.take(key, budget)
+
+    async def stop(self):
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+    def status(self) -> dict:
+        return {
+            "backend": "redis",
+            "errors": self.errors,
+            "idle_connections": len(self._idle),
+            "max_connections": self.max_connections,
+            "fallback_keys": len(self.fallback.buckets),
+        }
+
+
+def _create_store(kind: str = RATE_LIMIT_BACKEND):
+    """RATE_LIMIT_BACKEND: "" (default, this worker only) or "redis"."""
+    if kind == "redis":
+        return RedisStore()
+    return MemoryStore()
+
+
+def _match(method: str, path: str) -> Optional[Rule]:
+    for rule in RULES:
+        if method in rule.methods and (rule.paths is None or path in rule.paths):
+            return rule
+    return None
+
+
+def _header(scope: Scope, name: bytes) -> Optional[str]:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _ip_key(scope: Scope) -> str:
+    # The peer address, behind a proxy uvicorn's --proxy-headers puts the real client here
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+def _client_key(scope: Scope, key: str, body: Optional[bytes] = None) -> str:
+    if key == "account" and body:
+        try:
+            email = orjson.loads(body).get("email")
+        except (orjson.JSONDecodeError, AttributeError):
+            email = None
+        if isinstance(email, str) and email:
+            return _ip_key(scope) + ":account:" + email.strip().lower()
+    if key == "user":
+        authorization = _header(scope, b"authorization")
+        if authorization and authorization[:7].lower() == "bearer ":
+            try:
+                # Cached, the route's own verification of the same token is then a hit
+                return "user:" + decode_token(authorization[7:])["sub"]
+            except HTTPException:
+                pass
+    return _ip_key(scope)
+
+
+async def _read_body(receive: Receive) -> Tuple[Optional[bytes], List[dict]]:
+    """
+    The request body, when it fits in MAX_ACCOUNT_BODY, and the messages read to get
+    it, which are replayed to the app. Stops reading as soon as the limit is passed.
+    """
+    messages = []
+    body = b""
+    while True:
+        message = await receive()
+        messages.append(message)
+        if message["type"] != "http.request":
+            return None, messages
+        body += message.get("body", b"")
+        if len(body) > MAX_ACCOUNT_BODY:
+            return None, messages
+        if not message.get("more_body", False):
+            return body, messages
+
+
+def _replay(messages: List[dict], receive: Receive) -> Receive:
+    async def replayed():
+        if messages:
+            return messages.pop(0)
+        return await receive()
+    return replayed
+
+
+async def _reject(send: Send, status: int, detail: str, retry_after: float):
+    body = orjson.dumps({"detail": detail})
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimiter:
+    """
+    Admission control for HTTP requests, before any route code or database work runs.
+    The login, register, refresh and write routes each have a token bucket per
+    client (RULES), a client over its budget gets a 429 with Retry-After. Then at
+    most max_concurrent requests run at once on this worker, the ones beyond that
+    get a 503 right away: a quick retry later beats waiting in line for a database
+    connection behind a burst, which is what makes everyone's tail latency grow.
+    """
+    def __init__(self, store=None, max_concurrent: int = MAX_CONCURRENT_REQUESTS):
+        self.store = store if store is not None else _create_store()
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.stats: Dict[str, int] = {"limited": 0, "overloaded": 0}
+
+    async def stop(self):
+        await self.store.stop()
+
+    def status(self) -> dict:
+        return {
+            **self.stats,
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "store": self.store.status(),
+            "rules": {
+                rule.name: {
+                    "key": rule.key,
+                    "budget": rule.budget._asdict() if rule.budget else None,
+                    "ip_budget": rule.ip_budget._asdict() if rule.ip_budget else None,
+                }
+                for rule in RULES
+            },
+        }
+
+
+rate_limiter = RateLimiter()
+
+
+class RateLimitMiddleware:
+    """Plain ASGI so streaming responses pass through untouched, websockets aren't limited."""
+    def __init__(self, app: ASGIApp, limiter: RateLimiter = rate_limiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"].startswith(EXEMPT_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        limiter = self.limiter
+        rule = _match(scope["method"], scope["path"])
+        if rule is not None:
+            body = None
+            if rule.key == "account" and rule.budget is not None:
+                body, messages = await _read_body(receive)
+                receive = _replay(messages, receive)
+
+            wait = 0.0
+            if rule.budget is not None:
+                wait = await limiter.store.take(rule.name + ":" + _client_key(scope, rule.key, body), rule.budget)
+            if not wait and rule.ip_budget is not None:
+                wait = await limiter.store.take(rule.name + "_ip:" + _ip_key(scope), rule.ip_budget)
+            if wait > 0:
+                limiter.stats["limited"] += 1
+                await _reject(send, 429, "Too many requests, slow down", wait)
+                return
+
+        if limiter.max_concurrent and limiter.active >= limiter.max_concurrent:
+            limiter.stats["overloaded"] += 1
+            await _reject(send, 503, "Server busy, try again", 1)
+            return
+
+        limiter.active += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.active -= 1
@@ -1,12 +1,20 @@
-from fastapi import FastAPI, HTTPException, Depends, APIRouter, status, Header
+from fastapi import FastAPI, HTTPException, Depends, APIRouter, status, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from database.database import SessionLocal
-from database.cases_database import CaseItem
+import json
+import re
+from sqlalchemy import cast, func, literal, select, update
+from sqlalchemy.dialects.postgresql import JSONB, JSONPATH, array
+from sqlalchemy.exc import DataError, ProgrammingError
+from sqlalchemy.orm import Session, load_only
+from database.database import get_db, get_read_db, SessionLocal, ReadSessionLocal
+from database.cases_database import CaseItem, SEARCH_CONFIG
+from database.pagination import paginate, stream_ndjson, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from database.bulk import bulk_import
+from cache import payload_cache
 from security.verify import verify_jwt_token  # Import the verify_jwt_token function
 from security.create_token import create_access_token
-from pydantic import BaseModel, EmailStr, Field
-from typing import Optional, Dict, Any
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
+from typing import Optional, Dict, Any, List
 
 
 router = APIRouter(
@@ -16,52 +24,277 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 @router.get("/root")
 async def root():
     return {'message': "Cases root path!, Working maybe!"}
 
+# The columns a case is returned with
+CASE_COLUMNS = (
+    CaseItem.id,
+    CaseItem.user_id,
+    CaseItem.case_name,
+    CaseItem.patient_name,
+    CaseItem.patient_id,
+    CaseItem.base_values,
+    CaseItem.base_problem,
+    CaseItem.learning_goals,
+    CaseItem.start_point,
+    CaseItem.ai_summary,
+    CaseItem.medication_list,
+    CaseItem.lab_samples,
+    CaseItem.version,
+)
+
+def case_dict(case: CaseItem) -> dict:
+    return {column.key: getattr(case, column.key) for column in CASE_COLUMNS}
+
+# Response models, FastAPI validates and serializes these straight to JSON with pydantic-core
+class CaseOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    user_id: int
+    case_name: str
+    patient_name: str
+    patient_id: str
+    base_values: Dict[str, Any]
+    base_problem: str
+    learning_goals: str
+    start_point: str
+    ai_summary: str
+    medication_list: str
+    lab_samples: str
+    version: int
+
+class CaseCreated(BaseModel):
+    message: str
+    body: CaseOut
+
+class CaseUpdated(BaseModel):
+    message: str
+    fields_updated: Dict[str, Any]
+    case: CaseOut
+
+class CaseSearchHit(BaseModel):
+    id: int
+    case_name: str
+    patient_name: str
+    rank: float
+    snippet: str
+
+def _filter_cases(query, user_id: Optional[int], name: Optional[str]):
+    if user_id is not None:
+        query = query.filter(CaseItem.user_id == user_id)
+    if name:
+        query = query.filter(CaseItem.case_name.startswith(name, autoescape=True))
+    return query
+
 # Get all cases
-@router.get("/", status_code=status.HTTP_200_OK)
-async def get_cases(
-    db: Session = Depends(get_db)
+@router.get("/", status_code=status.HTTP_200_OK, response_model=List[CaseOut])
+def get_cases(
+    response: Response,
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user_id: Optional[int] = None,
+    name: Optional[str] = None,
+    stream: bool = False,
+    db: Session = Depends(get_read_db)
 ):
     """
-    Get all cases
+    Get all cases, a page at a time.
+    Params:
+        after: the id cursor from the previous page's X-Next-Cursor header.
+        limit: page size.
+        user_id: only cases made by this user.
+        name: only cases whose name starts with this.
+        stream: export every matching case as NDJSON instead of a page.
     Returns:
-        All cases.
+        A page of cases, X-Next-Cursor is set when there are more.
     """
-    cases = db.query(CaseItem).all()
+    if stream:
+        return stream_ndjson(
+            lambda stream_db: _filter_cases(stream_db.query(CaseItem).options(load_only(*CASE_COLUMNS)), user_id, name),
+            CaseItem.id,
+            case_dict,
+        )
+
+    query = _filter_cases(db.query(CaseItem).options(load_only(*CASE_COLUMNS)), user_id, name)
+    cases = paginate(query, CaseItem.id, after, limit, response)
 
-    if not cases:
+    if not cases and after is None:
         raise HTTPException(status_code=404, detail="No cases found")
 
+    return cases
+
+# Export cases, declared before /{case_id} so "export" isn't taken for an id
+@router.get("/export", status_code=status.HTTP_200_OK)
+def export_cases(
+    user_id: Optional[int] = None,
+    name: Optional[str] = None,
+):
+    """
+    Stream cases as NDJSON in the POST /cases/import format (no ids or owners),
+    to copy a case library between courses or servers.
+    Params:
+        user_id, name: the same filters as GET /cases/.
+    """
+    return stream_ndjson(
+        lambda db: _filter_cases(db.query(CaseItem).options(load_only(*CASE_COLUMNS)), user_id, name),
+        CaseItem.id,
+        lambda case: {field: getattr(case, field) for field in CaseCreate.model_fields},
+    )
+
+# Returned by /cases/query unless fields asks for others, the long texts are left out
+QUERY_FIELDS = ("id", "user_id", "case_name", "patient_name", "version")
+CASE_FIELDS = {column.key: column for column in CASE_COLUMNS}
+
+# Query cases by their base_values, declared before /{case_id} so "query" isn't taken for an id
+@router.get("/query", status_code=status.HTTP_200_OK)
+def query_cases(
+    response: Response,
+    contains: Optional[str] = None,
+    match: Optional[str] = None,
+    keys: Optional[str] = None,
+    fields: Optional[str] = None,
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Find cases by their base_values, all the given predicates have to hold.
+    The GIN index on base_values answers contains, keys and match predicates that only
+    compare with == (e.g. $.blood_type == "A+"). Any other match (ranges like
+    $.pulse > 120, like_regex, ...) is checked row by row, so combine it with contains
+    or keys to narrow the rows down first.
+    Params:
+        contains: JSON object base_values has to contain, e.g. {"blood_type": "A+"} (@>).
+        match: JSON path predicate, e.g. $.pulse > 120 (@@).
+        keys: comma separated keys base_values has to have, e.g. pulse,spo2 (?&).
+        fields: comma separated case fields to return, id is always included. Defaults to a summary without the long texts.
+        after, limit: keyset pagination like GET /cases/, see X-Next-Cursor.
+    """
+    conditions = []
+
+    if contains:
+        try:
+            document = json.loads(contains)
+        except ValueError:
+            document = None
+        if not isinstance(document, dict):
+            raise HTTPException(status_code=400, detail="contains must be a JSON object")
+        conditions.append(CaseItem.base_values.contains(document))
+
+    if match:
+        conditions.append(CaseItem.base_values.op("@@")(cast(match, JSONPATH)))
+
+    required = [k.strip() for k in (keys or "").split(",") if k.strip()]
+    if required:
+        conditions.append(CaseItem.base_values.has_all(array(required)))
+
+    names = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(QUERY_FIELDS)
+    unknown = [name for name in names if name not in CASE_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    if "id" not in names:
+        names.insert(0, "id")
+
+    query = db.query(*(CASE_FIELDS[name] for name in names)).filter(*conditions)
+
+    try:
+        cases = paginate(query, CaseItem.id, after, limit, response)
+    except (DataError, ProgrammingError):
+        # Postgres rejected the JSON path
+        db.rollback()
+        raise HTTPException(status_code=400, detail="match is not a valid JSON path predicate")
+
+    return [dict(case._mapping) for case in cases]
+
+# Texts the search snippets are cut from
+SEARCH_TEXTS = (
+    CaseItem.base_problem,
+    CaseItem.learning_goals,
+    CaseItem.start_point,
+    CaseItem.ai_summary,
+    CaseItem.medication_list,
+    CaseItem.lab_samples,
+)
+HEADLINE_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxFragments=3, MinWords=5, MaxWords=20, FragmentDelimiter=" ... "'
+
+# Full text search, declared before /{case_id} too
+@router.get("/search", status_code=status.HTTP_200_OK, response_model=List[CaseSearchHit])
+def search_cases(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Search the case texts, best matches first.
+    Params:
+        q: search words, web search syntax: "quoted phrases", or, -excluded.
+        limit, offset: which results to return.
+    Returns:
+        id, case_name, patient_name, rank and a snippet with the matches in <mark></mark>, not the whole case.
+    """
+    ts_query = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+
+    # Rank on the indexed vector first, only the returned page gets the (slower) snippets
+    ranked = (
+        select(
+            CaseItem.id,
+            CaseItem.case_name,
+            CaseItem.patient_name,
+            func.ts_rank(CaseItem.search_vector, ts_query).label("rank"),
+        )
+        .where(CaseItem.search_vector.op("@@")(ts_query))
+        .order_by(func.ts_rank(CaseItem.search_vector, ts_query).desc(), CaseItem.id)
+        .limit(limit)
+        .offset(offset)
+        .subquery()
+    )
+
+    snippet = func.ts_headline(SEARCH_CONFIG, func.concat_ws("\n", *SEARCH_TEXTS), ts_query, HEADLINE_OPTIONS)
+    rows = db.execute(
+        select(ranked, snippet.label("snippet"))
+        .join(CaseItem, CaseItem.id == ranked.c.id)
+        .order_by(ranked.c.rank.desc(), ranked.c.id)
+    ).all()
+
     return [
-        {   
-            case
+        {
+            "id": row.id,
+            "case_name": row.case_name,
+            "patient_name": row.patient_name,
+            "rank": round(row.rank, 4),
+            "snippet": row.snippet,
         }
-        for case in cases
+        for row in rows
     ]
 
 # GET single case
-@router.get("/{case_id}", status_code=status.HTTP_200_OK)
-async def get_single_case(
+@router.get("/{case_id}", status_code=status.HTTP_200_OK, response_model=CaseOut)
+def get_single_case(
     case_id: int,
-    db: Session = Depends(get_db)
+    if_none_match: Optional[str] = Header(None),
 ):
-    """Get single case for id"""
-    case = db.query(CaseItem).filter(CaseItem.id == case_id).first()
+    """
+    Get single case for id, served from the payload cache when it can be.
+    The ETag header is its version, for PATCH If-Match and If-None-Match (304).
+    """
+    def load(primary: bool):
+        # Only a cache miss opens a session
+        with (SessionLocal if primary else ReadSessionLocal)() as db:
+            case = db.query(CaseItem).options(load_only(*CASE_COLUMNS)).filter(CaseItem.id == case_id).first()
+            if not case:
+                return None
+            return case_dict(case), (f"case:{case.id}",), f'"{case.version}"'
 
-    if not case:
+    entry = payload_cache.get_or_load(("case", case_id), load)
+
+    if entry is None:
         raise HTTPException(status_code=404, detail="Case found")
      
-    return case
+    return payload_cache.response(entry, if_none_match)
 
 # Case model for POST method
 class CaseCreate(BaseModel):
@@ -78,8 +311,8 @@ class CaseCreate(BaseModel):
 
 
 # Create Case
-@router.post("/", status_code=status.HTTP_201_CREATED)
-async def create_case(
+@router.post("/", status_code=status.HTTP_201_CREATED, response_model=CaseCreated)
+def create_case(
     data: CaseCreate,
     db: Session = Depends(get_db),
     payload: dict = Depends(verify_jwt_token)
@@ -107,14 +340,42 @@ async def create_case(
         'body': new_case
     }
 
-# Merging the document column with the new incoming changes if there are any
-def deep_merge(dst: dict, src: dict) -> dict:
-    for k, v in src.items():
-        if isinstance(v, dict) and isinstance(dst.get(k), dict):
-            deep_merge(dst[k], v)
-        else:
-            dst[k] = v
-    return dst
+class ImportSummary(BaseModel):
+    inserted: int
+    failed: int
+    committed: bool
+    # The first rows that failed, by row (line) number
+    errors: List[Dict[str, Any]]
+
+# Import cases in bulk
+@router.post("/import", status_code=status.HTTP_201_CREATED, response_model=ImportSummary)
+async def import_cases(
+    request: Request,
+    response: Response,
+    atomic: bool = False,
+    payload: dict = Depends(verify_jwt_token)
+):
+    """
+    Create many cases at once, owned by the caller, in one transaction.
+    Body: NDJSON (one case per line, like GET /cases/export gives) or a JSON array
+    (Content-Type: application/json), each case like the POST /cases/ body.
+    Params:
+        atomic: import nothing if any row is invalid (422), by default invalid rows are skipped.
+    Returns:
+        How many cases were inserted and which rows failed and why.
+    """
+    user_id = int(payload.get('sub'))
+    summary = await bulk_import(
+        request,
+        CaseCreate,
+        lambda data: {"user_id": user_id, **data.model_dump()},
+        CaseItem,
+        atomic=atomic,
+    )
+
+    if not summary["committed"]:
+        response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    return summary
 
 class CaseUpdate(BaseModel):
     case_name: Optional[str] = None
@@ -128,52 +389,89 @@ class CaseUpdate(BaseModel):
     medication_list: Optional[str] = None
     lab_samples: Optional[str] = None
 
+# One entity-tag, and a whole If-Match list of them (RFC 9110 8.8.3)
+ETAG = r'\s*(W/)?"([^"]*)"\s*'
+ETAG_LIST = re.compile(ETAG + r'(?:,' + ETAG + r')*')
+
+def _parse_if_match(if_match: str) -> Optional[List[int]]:
+    """
+    The case versions If-Match accepts, None for "*" (any current version).
+    The ETag is the quoted version, e.g. "3". If-Match compares strongly, so weak
+    (W/) and foreign tags are kept out and can only fail the precondition.
+    """
+    if if_match.strip() == "*":
+        return None
+    if not ETAG_LIST.fullmatch(if_match):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="If-Match must be * or a list of the case's ETags")
+    return [
+        int(tag) for weak, tag in re.findall(r'(W/)?"([^"]*)"', if_match)
+        if not weak and tag.isdigit()
+    ]
+
 # Edit cases
-@router.patch("/{case_id}", status_code=status.HTTP_200_OK)
-async def update_case(
+@router.patch("/{case_id}", status_code=status.HTTP_200_OK, response_model=CaseUpdated)
+def update_case(
     case_id: int,
     updates: CaseUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     db: Session = Depends(get_db),
 ):  
     """
     Update a specific and existing case with the case ID.
+    base_values is deep merged into the stored document by Postgres (jsonb_deep_merge)
+    in the same UPDATE, so concurrent edits to different keys don't overwrite each other.
     Params:
         Check example body.
+        If-Match: optional ETag (version) from GET, or a list of them, the update fails with 412 if the
+            case changed since. * only requires the case to exist.
     """
-    case = db.query(CaseItem).filter(CaseItem.id == case_id).first()
-
-    if not case:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Case not found")
-
     payload = updates.model_dump(exclude_unset=True, exclude=None)
 
     if "base_values" in payload:
         incoming = payload.pop("base_values") or {}
+        payload["base_values"] = func.jsonb_deep_merge(
+            func.coalesce(CaseItem.base_values, literal({}, JSONB)),
+            literal(incoming, JSONB),
+            type_=JSONB,
+        )
 
-        if case.base_values is None:
-            case.base_values = {}
+    payload["version"] = CaseItem.version + 1
 
-        case.base_values = deep_merge(case.base_values, incoming)
+    stmt = update(CaseItem).where(CaseItem.id == case_id)
+    versions = _parse_if_match(if_match) if if_match is not None else None
+    if versions is not None:
+        stmt = stmt.where(CaseItem.version.in_(versions))
 
-    for key, value in payload.items():
-        setattr(case, key, value)
+    # One round trip, the updated row comes back with RETURNING
+    case = db.execute(
+        stmt.values(**payload).returning(*CASE_COLUMNS).execution_options(synchronize_session=False)
+    ).first()
 
-    # Update only the fields sent, not all
-    #for key, value in updates.model_dump(exclude_unset=True).items():
-    #    setattr(case, key, value)
+    if not case:
+        db.rollback()
+        if if_match is not None and versions is None:
+            # "*" only holds while the case exists
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Case doesn't exist")
+        if if_match is not None and db.query(CaseItem.id).filter(CaseItem.id == case_id).first():
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Case was changed by someone else")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Case not found")
 
     db.commit()
-    db.refresh(case)
+    payload_cache.invalidate(f"case:{case_id}")
+
+    case = dict(case._mapping)
+    response.headers["ETag"] = f'"{case["version"]}"'
 
     return {
-        "message": f"Case (ID: {case.id} Name: {case.case_name}) updated successfully",
+        "message": f"Case (ID: {case['id']} Name: {case['case_name']}) updated successfully",
         "fields_updated": updates.model_dump(exclude_unset=True, exclude_none=True),
         "case": case
     }
 
 # DELETE case
 @router.delete("/{case_id}", status_code=status.HTTP_200_OK)
-async def delete_case(
+def delete_case(
     case_id: int,
     db: Session = Depends(get_db)
 ):
@@ -191,6 +489,7 @@ async def delete_case(
     
     db.delete(case)
     db.commit()
+    payload_cache.invalidate(f"case:{case_id}")
 
     return {
         "message": f"Case (ID: {case.id} Name: {case.case_name}) removed successfully"
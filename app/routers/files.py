@@ -2,12 +2,11 @@ import shutil
 from fastapi import FastAPI, HTTPException, Depends, APIRouter, status, Header, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from database.database import SessionLocal
 from database.files_database import FileItem
 from security.verify import verify_jwt_token  # Import the verify_jwt_token function
 from security.create_token import create_access_token
 from pydantic import BaseModel, EmailStr, Field
-from typing import Optional
+from typing import List, Optional
 from config import UPLOAD_DIR
 from pathlib import Path
 from uuid import uuid4
@@ -19,19 +18,25 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Response models
+class ImageUploaded(BaseModel):
+    url: str
+
+class RoomImages(BaseModel):
+    room_id: str
+    images: List[str]
+
+class ImagesDeleted(BaseModel):
+    room_id: str
+    deleted: bool
+    reason: Optional[str] = None
 
 @router.get("/root")
 async def root():
     return {'message': "Files root path!, Working maybe!"}
 
-@router.post("/{room_id}/images")
-async def upload_image(
+@router.post("/{room_id}/images", response_model=ImageUploaded)
+def upload_image(
     room_id: str,
     request: Request,
     file: UploadFile = File(...),
@@ -54,10 +59,10 @@ async def upload_image(
 
     image_url = request.url_for("images", path=f'{room_id}/{filename}')
 
-    return { 'url': image_url }
+    return { 'url': str(image_url) }
 
-@router.get("/{room_id}/images")
-async def get_images(
+@router.get("/{room_id}/images", response_model=RoomImages)
+def get_images(
     room_id: str,
     request: Request
 ):
@@ -73,15 +78,15 @@ async def get_images(
     for file_path in room_dir.iterdir():
         if file_path.is_file():
             url = request.url_for("images", path=f"{room_id}/{file_path.name}")
-            image_urls.append(url)
+            image_urls.append(str(url))
     
     return {
         "room_id": room_id,
         "images": image_urls
     }
 
-@router.delete("/{room_id}/images")
-async def delete_images(
+@router.delete("/{room_id}/images", response_model=ImagesDeleted, response_model_exclude_none=True)
+def delete_images(
     room_id: str
 ):
     room_dir = UPLOAD_DIR / room_id
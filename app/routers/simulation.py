@@ -1,12 +1,23 @@
-from fastapi import FastAPI, HTTPException, Depends, APIRouter, status, Header
+from fastapi import FastAPI, HTTPException, Depends, APIRouter, status, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from database.database import SessionLocal
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload, load_only
+from database.database import get_db, get_read_db, SessionLocal, ReadSessionLocal
 from database.simulation_database import SimulationItem
+from database.pagination import paginate, stream_ndjson, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from database.cases_database import CaseItem
+from database.bulk import bulk_import
+from routers.cases import CASE_COLUMNS, CaseOut, ImportSummary, case_dict
+from database.events_database import SimulationEventItem
+from websocket.admission import admission_cache
+from cache import payload_cache
 from security.verify import verify_jwt_token  # Import the verify_jwt_token function
 from security.create_token import create_access_token
-from pydantic import BaseModel, EmailStr, Field
-from typing import Optional
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
+from typing import Dict, List, Optional, Union
+from datetime import datetime
+import orjson
 
 
 router = APIRouter(
@@ -16,51 +27,141 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 @router.get("/root")
 async def root():
     return {'message': "Simulations root path!, Working maybe!"}
 
+# The columns the simulation responses return, nothing else is loaded
+SIM_COLUMNS = (
+    SimulationItem.id,
+    SimulationItem.user_id,
+    SimulationItem.case_id,
+    SimulationItem.name,
+    SimulationItem.nurse_notes,
+    SimulationItem.ergo_notes,
+    SimulationItem.phys_notes,
+    SimulationItem.state,
+)
+
+# Response models, FastAPI validates and serializes these straight to JSON with pydantic-core
+class SimulationOut(BaseModel):
+    id: int
+    user_id: int
+    case_id: int
+    name: str
+    nurse_notes: Optional[str] = None
+    ergo_notes: Optional[str] = None
+    phys_notes: Optional[str] = None
+    state: bool
+    # Only when expanded, the routes leave it out otherwise (response_model_exclude_unset)
+    case: Optional[CaseOut] = None
+
+# What the owner of a simulation gets back, with the passphrase
+class OwnedSimulationOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    user_id: int
+    case_id: int
+    name: str
+    nurse_notes: Optional[str] = None
+    ergo_notes: Optional[str] = None
+    phys_notes: Optional[str] = None
+    passphrase: str
+    state: bool
+
+class SimulationUpdated(BaseModel):
+    message: str
+    simulation: OwnedSimulationOut
+
+def _parse_expand(expand: str) -> set:
+    return {part.strip() for part in expand.split(",") if part.strip()}
+
+def _sim_query(db: Session, expand: set):
+    """Simulations with only the response columns, the case comes in the same query (one JOIN) when expanded."""
+    query = db.query(SimulationItem).options(load_only(*SIM_COLUMNS))
+    if "case" in expand:
+        query = query.options(joinedload(SimulationItem.case, innerjoin=True).load_only(*CASE_COLUMNS))
+    return query
+
+def _sim_response(sim: SimulationItem, expand: set) -> dict:
+    body = {column.key: getattr(sim, column.key) for column in SIM_COLUMNS}
+    if "case" in expand:
+        body["case"] = case_dict(sim.case)
+    return body
+
+def _filter_sims(query, user_id: Optional[int], state: Optional[bool], name: Optional[str]):
+    if user_id is not None:
+        query = query.filter(SimulationItem.user_id == user_id)
+    if state is not None:
+        query = query.filter(SimulationItem.state == state)
+    if name:
+        query = query.filter(SimulationItem.name.startswith(name, autoescape=True))
+    return query
+
 # Get all active simulations
-@router.get("/", status_code=status.HTTP_200_OK)
-async def get_all_active_sims(
-    db: Session = Depends(get_db)
+@router.get(
+    "/",
+    status_code=status.HTTP_200_OK,
+    response_model=Union[List[SimulationOut], Dict[str, str]],
+    response_model_exclude_unset=True,
+)
+def get_all_active_sims(
+    response: Response,
+    expand: str = "case",
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user_id: Optional[int] = None,
+    state: Optional[bool] = True,
+    name: Optional[str] = None,
+    stream: bool = False,
+    db: Session = Depends(get_read_db)
 ):
-    """Get all active Simulations."""
-    active_sims = db.query(SimulationItem).filter(SimulationItem.state == True).all()
+    """
+    Get the active Simulations, a page at a time.
+    Params:
+        expand: "case" (default) embeds each simulation's case, send it empty (?expand=) to leave the case out.
+        after: the id cursor from the previous page's X-Next-Cursor header.
+        limit: page size.
+        user_id: only simulations made by this user.
+        state: active (default) or inactive simulations.
+        name: only simulations whose name starts with this.
+        stream: export every matching simulation as NDJSON instead of a page.
+    """
+    expand = _parse_expand(expand)
+
+    if stream:
+        return stream_ndjson(
+            lambda stream_db: _filter_sims(_sim_query(stream_db, expand), user_id, state, name),
+            SimulationItem.id,
+            lambda sim: _sim_response(sim, expand),
+        )
 
-    if not active_sims:
+    query = _filter_sims(_sim_query(db, expand), user_id, state, name)
+    active_sims = paginate(query, SimulationItem.id, after, limit, response)
+
+    if not active_sims and after is None:
         return { "message": "No active simulations found" }
     
-    return [
-        {
-            "id": sim.id,
-            "user_id": sim.user_id,
-            "case_id": sim.case_id,
-            "name": sim.name,
-            "nurse_notes": sim.nurse_notes,
-            "ergo_notes": sim.ergo_notes,
-            "phys_notes": sim.phys_notes,
-            "state": sim.state,
-            "case": sim.case
-        }
-        for sim in active_sims
-    ]
+    return [_sim_response(sim, expand) for sim in active_sims]
+
 
+def _user_sim_response(sim: SimulationItem) -> dict:
+    return OwnedSimulationOut.model_validate(sim).model_dump()
 
 # Get all simulations for a user
-@router.get("/user", status_code=status.HTTP_200_OK)
-async def get_user_simulations(
-    db: Session = Depends(get_db), 
+@router.get("/user", status_code=status.HTTP_200_OK, response_model=List[OwnedSimulationOut])
+def get_user_simulations(
+    response: Response,
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    state: Optional[bool] = None,
+    name: Optional[str] = None,
+    stream: bool = False,
+    db: Session = Depends(get_read_db), 
     payload: dict = Depends(verify_jwt_token)
 ):
-    """Get all of the users made simulations"""
+    """Get the users made simulations, a page at a time, filtered and paged like GET /simulations/"""
     sub = payload.get('sub')
 
     try:
@@ -68,50 +169,114 @@ async def get_user_simulations(
     except (TypeError, ValueError):
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    user_sims = db.query(SimulationItem).filter(SimulationItem.user_id == user_id).all()
+    if stream:
+        return stream_ndjson(
+            lambda stream_db: _filter_sims(stream_db.query(SimulationItem), user_id, state, name),
+            SimulationItem.id,
+            _user_sim_response,
+        )
+
+    query = _filter_sims(db.query(SimulationItem), user_id, state, name)
+    user_sims = paginate(query, SimulationItem.id, after, limit, response)
 
-    if not user_sims:
+    if not user_sims and after is None:
         raise HTTPException(status_code=404, detail="No simulations found for user")
     
-    return [
-        {
-            "id": sim.id,
-            "case_id": sim.case_id,
-            "name": sim.name,
-            "nurse_notes": sim.nurse_notes,
-            "ergo_notes": sim.ergo_notes,
-            "phys_notes": sim.phys_notes,
-            "passphrase": sim.passphrase,
-            "state": sim.state
-        }
-        for sim in user_sims
-    ]
+    return user_sims
+
+# Export the callers simulations, declared before /{sim_id} so "export" isn't taken for an id
+@router.get("/export", status_code=status.HTTP_200_OK)
+def export_simulations(
+    state: Optional[bool] = None,
+    name: Optional[str] = None,
+    payload: dict = Depends(verify_jwt_token)
+):
+    """
+    Stream the users own simulations as NDJSON in the POST /simulations/import format.
+    Params:
+        state, name: the same filters as GET /simulations/user.
+    """
+    user_id = int(payload.get('sub'))
+    return stream_ndjson(
+        lambda db: _filter_sims(db.query(SimulationItem), user_id, state, name),
+        SimulationItem.id,
+        lambda sim: {field: getattr(sim, field) for field in SimulationCreate.model_fields},
+    )
 
 # Get individual Simulation
-@router.get("/{sim_id}", status_code=status.HTTP_200_OK)
-async def get_single_sim(
+@router.get("/{sim_id}", status_code=status.HTTP_200_OK, response_model=SimulationOut, response_model_exclude_unset=True)
+def get_single_sim(
     sim_id: int,
-    db: Session = Depends(get_db)
+    expand: str = "case",
+    if_none_match: Optional[str] = Header(None),
 ):
-    """Get single simulation for id"""
-    sim = db.query(SimulationItem).filter(SimulationItem.id == sim_id).first()
+    """
+    Get single simulation for id, with its case unless expand is sent empty (?expand=).
+    Served from the payload cache when it can be, with an ETag for If-None-Match (304).
+    """
+    expand = _parse_expand(expand)
 
-    if not sim:
+    def load(primary: bool):
+        # Only a cache miss opens a session
+        with (SessionLocal if primary else ReadSessionLocal)() as db:
+            sim = _sim_query(db, expand).filter(SimulationItem.id == sim_id).first()
+            if not sim:
+                return None
+            # The embedded case goes stale with the case too
+            tags = (f"sim:{sim.id}", f"case:{sim.case_id}") if "case" in expand else (f"sim:{sim.id}",)
+            return _sim_response(sim, expand), tags, None
+
+    entry = payload_cache.get_or_load(("sim", sim_id, frozenset(expand)), load)
+
+    if entry is None:
         raise HTTPException(status_code=404, detail="Simulation not found")
 
-    #return simulation
+    return payload_cache.response(entry, if_none_match)
 
-    return {
-            "id": sim.id,
-            "user_id": sim.user_id,
-            "case_id": sim.case_id,
-            "name": sim.name,
-            "nurse_notes": sim.nurse_notes,
-            "ergo_notes": sim.ergo_notes,
-            "phys_notes": sim.phys_notes,
-            "state": sim.state,
-            "case": sim.case
-        }
+def _iter_events(sim_id: int, since: Optional[datetime], until: Optional[datetime]):
+    # Own session, the response keeps streaming after the request's dependencies are gone
+    db = ReadSessionLocal()
+    try:
+        query = select(
+            SimulationEventItem.seq,
+            SimulationEventItem.type,
+            SimulationEventItem.user_id,
+            SimulationEventItem.payload,
+            SimulationEventItem.created_at,
+        ).where(SimulationEventItem.room_id == str(sim_id))
+
+        if since:
+            query = query.where(SimulationEventItem.created_at >= since)
+        if until:
+            query = query.where(SimulationEventItem.created_at < until)
+
+        query = query.order_by(SimulationEventItem.created_at, SimulationEventItem.id)
+
+        # Server side cursor, only yield_per rows are held in memory at a time
+        for event in db.execute(query.execution_options(yield_per=1000)):
+            yield orjson.dumps({
+                "seq": event.seq,
+                "type": event.type,
+                "from": event.user_id,
+                "payload": event.payload,
+                "ts": event.created_at,
+            }) + b"\n"
+    finally:
+        db.close()
+
+# Replay a simulation
+@router.get("/{sim_id}/events", status_code=status.HTTP_200_OK)
+async def get_sim_events(
+    sim_id: int,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """
+    Stream the recorded timeline of a simulation as NDJSON, one event per line in the order they happened.
+    Params:
+        since, until: optional ISO timestamps to only get part of the timeline.
+    """
+    return StreamingResponse(_iter_events(sim_id, since, until), media_type="application/x-ndjson")
 
 class SimulationCreate(BaseModel):
     case_id: int
@@ -123,8 +288,8 @@ class SimulationCreate(BaseModel):
     state: bool = True
 
 # Create simulation
-@router.post("/", status_code=status.HTTP_201_CREATED)
-async def create_simulation(
+@router.post("/", status_code=status.HTTP_201_CREATED, response_model=OwnedSimulationOut)
+def create_simulation(
     data: SimulationCreate,
     db: Session = Depends(get_db),
     payload: dict = Depends(verify_jwt_token)
@@ -140,8 +305,49 @@ async def create_simulation(
     db.commit()
     db.refresh(new_sim)
 
+    # Joinable over /ws right away, without a database check on the handshake
+    admission_cache.put(new_sim)
+
     return new_sim    
 
+def _check_cases(db: Session, rows: list) -> dict:
+    # The foreign key would abort the whole import, so unknown cases are rejected per row
+    case_ids = {row["case_id"] for _, row in rows}
+    existing = {case_id for (case_id,) in db.query(CaseItem.id).filter(CaseItem.id.in_(case_ids))}
+    return {
+        number: f"Case {row['case_id']} doesn't exist"
+        for number, row in rows
+        if row["case_id"] not in existing
+    }
+
+# Import simulations in bulk
+@router.post("/import", status_code=status.HTTP_201_CREATED, response_model=ImportSummary)
+async def import_simulations(
+    request: Request,
+    response: Response,
+    atomic: bool = False,
+    payload: dict = Depends(verify_jwt_token)
+):
+    """
+    Create many simulations at once, owned by the caller, in one transaction.
+    Body: NDJSON or a JSON array of POST /simulations/ bodies, see POST /cases/import.
+    Params:
+        atomic: import nothing if any row is invalid (422), by default invalid rows are skipped.
+    """
+    user_id = int(payload.get('sub'))
+    summary = await bulk_import(
+        request,
+        SimulationCreate,
+        lambda data: {"user_id": user_id, **data.model_dump()},
+        SimulationItem,
+        check=_check_cases,
+        atomic=atomic,
+    )
+
+    if not summary["committed"]:
+        response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    return summary
+
 class SimUpdate(BaseModel):
     name: Optional[str] = None
     case_id: Optional[int] = None
@@ -152,8 +358,8 @@ class SimUpdate(BaseModel):
     state: Optional[bool] = None
 
 # Update sims
-@router.patch("/{sim_id}", status_code=status.HTTP_200_OK)
-async def update_sim(
+@router.patch("/{sim_id}", status_code=status.HTTP_200_OK, response_model=SimulationUpdated)
+def update_sim(
     sim_id: int,
     updates: SimUpdate,
     db: Session = Depends(get_db),
@@ -170,23 +376,18 @@ async def update_sim(
     db.commit()
     db.refresh(sim)
 
+    # Deactivating or a new passphrase applies to the next /ws handshake
+    admission_cache.put(sim)
+    payload_cache.invalidate(f"sim:{sim_id}")
+
     return {
         "message": f"Simulation {sim.name} updated successfully!",
-        "simulation": {
-            "id": sim.id,
-            "case_id": sim.case_id,
-            "name": sim.name,
-            "nurse_notes": sim.nurse_notes,
-            "ergo_notes": sim.ergo_notes,
-            "phys_notes": sim.phys_notes,
-            "passphrase": sim.passphrase,
-            "state": sim.state
-        }
+        "simulation": sim
     }
 
 # Delete sim
 @router.delete("/{sim_id}", status_code=status.HTTP_200_OK)
-async def delete_sim(
+def delete_sim(
     sim_id: int,
     db: Session = Depends(get_db),
     #payload: dict = Depends(get_db)
@@ -201,4 +402,7 @@ async def delete_sim(
     db.delete(sim)
     db.commit()
 
+    admission_cache.invalidate(sim_id)
+    payload_cache.invalidate(f"sim:{sim_id}")
+
     return {"message": f"Simulation {sim.name} removed"}
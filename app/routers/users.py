@@ -1,14 +1,23 @@
-from fastapi import FastAPI, HTTPException, Depends, APIRouter, status, Header
+from fastapi import FastAPI, HTTPException, Depends, APIRouter, status, Header, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from database.database import SessionLocal
+from database.database import get_db, get_read_db
 from database.users_database import UserItem
+from database.cases_database import CaseItem
+from database.simulation_database import SimulationItem
+from database.pagination import paginate, stream_ndjson, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 from security.verify import verify_jwt_token  # Import the verify_jwt_token function
 from security.create_token import create_access_token
-from passlib.context import CryptContext
+from security.passwords import hash_password, verify_password
+from security.refresh_tokens import issue_refresh_token, rotate_refresh_token, revoke_refresh_token, revoke_user_refresh_tokens
+from security.revocation import revocation_list
+from websocket.admission import admission_cache
+from cache import payload_cache
+from config import ACCESS_TOKEN_EXPIRE_MINUTES
 from constants import RoleEnum
-from typing import Optional
+from typing import Dict, List, Optional, Union
 
 # Split the endpoints into public and private, eg you have to be able to login and register without authorization
 public_router = APIRouter(
@@ -25,16 +34,6 @@ protected_router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
-
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 # Users root endpoint
 @public_router.get("/")
 async def root():
@@ -48,9 +47,35 @@ class UserCreate(BaseModel):
     password: str = Field(..., example="something_clever")
     role: RoleEnum = Field(..., example="student")
 
+# Response models, FastAPI validates and serializes these straight to JSON with pydantic-core.
+# The password hash is never part of one
+class UserOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    username: str
+    email: str
+    role: RoleEnum
+
+class UserUpdated(BaseModel):
+    message: str
+    user: UserOut
+
+class LoginUser(BaseModel):
+    name: str
+    email: str
+    role: RoleEnum
+
+class LoginOut(BaseModel):
+    access_token: str
+    refresh_token: str
+    token_type: str
+    expires_in: int
+    user: LoginUser
+
 # Register new users endpoint
-@public_router.post("/", status_code=status.HTTP_201_CREATED)
-async def register_user(user: UserCreate, db: Session = Depends(get_db)):
+@public_router.post("/", status_code=status.HTTP_201_CREATED, response_model=UserOut)
+def register_user(user: UserCreate, db: Session = Depends(get_db)):
     """
     Register a user within the service. 
     """
@@ -71,7 +96,7 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
         )
 
     # Hash password before saving
-    hashed_pw = pwd_context.hash(user.password)
+    hashed_pw = hash_password(user.password)
 
     new_user = UserItem(
         username=user.username,
@@ -81,27 +106,49 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
     )
 
     db.add(new_user)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # Someone registered the same email or username since the checks above
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email or username already registered"
+        )
     db.refresh(new_user)
 
-    return {"id": new_user.id, "username": new_user.username, "email": new_user.email, "role": new_user.role}
-
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return new_user
 
 class UserLogin(BaseModel):
     email: str
     password: str
 
 # Login user
-@public_router.post("/login")
-async def login(new_user: UserLogin, db: Session = Depends(get_db)):
+@public_router.post("/login", response_model=LoginOut)
+def login(new_user: UserLogin, db: Session = Depends(get_db)):
     """Login user, returns a jwttoken"""
 
     user = db.query(UserItem).filter(UserItem.email == new_user.email).first()
-    if not user or not verify_password(new_user.password, user.password):
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
+    # Give the connection back to the pool while Argon2 runs, the user stays loaded
+    db.close()
+
+    valid, new_hash = verify_password(new_user.password, user.password)
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    # Hashed with older Argon2 parameters, store it with the current ones
+    if new_hash:
+        db.query(UserItem).filter(UserItem.id == user.id).update({"password": new_hash})
+
+    refresh_token = issue_refresh_token(db, user.id)
+    db.commit()
+
+    return _token_response(user, refresh_token)
+
+def _token_response(user: UserItem, refresh_token: str) -> dict:
     access_token = create_access_token(
         data={
             "sub": str(user.id), 
@@ -113,14 +160,48 @@ async def login(new_user: UserLogin, db: Session = Depends(get_db)):
 
     return {
         "access_token": access_token,
+        "refresh_token": refresh_token,
         "token_type": "bearer",
-        "expires_in": 7200,
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
         "user": {"name": user.username, "email": user.email, "role": user.role }
     }
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+# Renew the access token
+@public_router.post("/refresh", response_model=LoginOut)
+def refresh(body: RefreshRequest, db: Session = Depends(get_db)):
+    """Swap a refresh token for a new access token and a new refresh token, the old refresh token stops working"""
+    user, refresh_token = rotate_refresh_token(db, body.refresh_token)
+    db.commit()
+
+    return _token_response(user, refresh_token)
+
+class LogoutRequest(BaseModel):
+    refresh_token: Optional[str] = None
+    everywhere: bool = False  # Revoke every token of the user, on all devices
+
+# Logout
+@protected_router.post("/logout", status_code=status.HTTP_200_OK)
+def logout(body: LogoutRequest, db: Session = Depends(get_db), payload: dict = Depends(verify_jwt_token)):
+    """Revoke the access token used for this request, and the given refresh token (or with everywhere, all of them)"""
+    user_id = int(payload.get("sub"))
+
+    revoked = [revocation_list.revoke_token(db, payload)]
+    if body.everywhere:
+        revoked.append(revocation_list.revoke_user(db, user_id))
+        revoke_user_refresh_tokens(db, user_id)
+    elif body.refresh_token:
+        revoke_refresh_token(db, body.refresh_token, user_id)
+    db.commit()
+    revocation_list.apply(*revoked)
+
+    return {"message": "Logged out"}
+
 # Get user information
-@protected_router.get("/me", status_code=status.HTTP_200_OK)
-async def get_user_data(db: Session = Depends(get_db), payload: dict = Depends(verify_jwt_token)):
+@protected_router.get("/me", status_code=status.HTTP_200_OK, response_model=UserOut)
+def get_user_data(db: Session = Depends(get_read_db), payload: dict = Depends(verify_jwt_token)):
     """Get the logged in users information"""
 
     user_id = int(payload.get('sub'))
@@ -129,12 +210,7 @@ async def get_user_data(db: Session = Depends(get_db), payload: dict = Depends(v
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
-    return {
-        "id": user.id,
-        "username": user.username,
-        "email": user.email,
-        "role": user.role
-    }
+    return user
 
 class UserUpdate(BaseModel):
     username: Optional[str] = None
@@ -142,8 +218,8 @@ class UserUpdate(BaseModel):
     password: Optional[str] = None
 
 # Update users things
-@protected_router.patch("/", status_code=status.HTTP_200_OK)
-async def update_current_user(
+@protected_router.patch("/", status_code=status.HTTP_200_OK, response_model=UserUpdated)
+def update_current_user(
     updates: UserUpdate, 
     db: Session = Depends(get_db), 
     payload: dict = Depends(verify_jwt_token)
@@ -154,31 +230,37 @@ async def update_current_user(
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
+    revoked = []
     if updates.password:
-        updates.password = pwd_context.hash(updates.password)
-        print(updates.password)
+        updates.password = hash_password(updates.password)
+        # Tokens from before the change stop working, this one too, so log in again
+        revoked = [revocation_list.revoke_user(db, user_id), revocation_list.revoke_token(db, payload)]
+        revoke_user_refresh_tokens(db, user_id)
 
     for key, value in updates.model_dump(exclude_unset=True).items():
         setattr(user, key, value)
     
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # The new email or username belongs to someone else (unique indexes)
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email or username already registered"
+        )
+    revocation_list.apply(*revoked)
     db.refresh(user)
     
     return {
         "message": f"User {user.username} updated successfully",
-        "user": {
-            "id": user.id,
-            "username": user.username,
-            "email": user.email,
-            "role": user.role,
-            "temp": user.password
-        }
+        "user": user
     }
 
 
 # Delete user
 @protected_router.delete("/", status_code=status.HTTP_200_OK)
-async def delete_user(db: Session = Depends(get_db), payload: dict = Depends(verify_jwt_token)):
+def delete_user(db: Session = Depends(get_db), payload: dict = Depends(verify_jwt_token)):
     """
     Delete a user based on the valid jwt token that is active when request is made. Removes the possibility of someone deleting other users.
     Returns: 
@@ -193,27 +275,58 @@ async def delete_user(db: Session = Depends(get_db), payload: dict = Depends(ver
             detail="User doesn't exist"
         )
     
+    # The user's cases and simulations go with it, their cached payloads and admissions have to as well
+    case_ids = [id for (id,) in db.query(CaseItem.id).filter(CaseItem.user_id == user_id)]
+    sim_ids = [id for (id,) in db.query(SimulationItem.id).filter(SimulationItem.user_id == user_id)]
+
+    # Refresh tokens go with the user (ON DELETE CASCADE), access tokens are revoked
+    revoked = [revocation_list.revoke_user(db, user_id), revocation_list.revoke_token(db, payload)]
     db.delete(user)
     db.commit()
+    revocation_list.apply(*revoked)
+
+    for sim_id in sim_ids:
+        admission_cache.invalidate(sim_id)
+    if case_ids or sim_ids:
+        payload_cache.invalidate(*[f"case:{id}" for id in case_ids], *[f"sim:{id}" for id in sim_ids])
 
     return {'message': f'User: {user_id} removed'}
 
+def _user_response(user: UserItem) -> dict:
+    return UserOut.model_validate(user).model_dump()
+
+def _filter_users(query, role: Optional[RoleEnum], username: Optional[str]):
+    if role is not None:
+        query = query.filter(UserItem.role == role)
+    if username:
+        query = query.filter(UserItem.username.startswith(username, autoescape=True))
+    return query
+
 # Get all users
-@protected_router.get("/all", status_code=status.HTTP_200_OK)
-async def get_all_users(db: Session = Depends(get_db)):
-    users = db.query(UserItem).all()
+@protected_router.get("/all", status_code=status.HTTP_200_OK, response_model=Union[List[UserOut], Dict[str, str]])
+def get_all_users(
+    response: Response,
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    role: Optional[RoleEnum] = None,
+    username: Optional[str] = None,
+    stream: bool = False,
+    db: Session = Depends(get_read_db)
+):
+    """
+    Get the users a page at a time, the next page's cursor is in the X-Next-Cursor header.
+    Filters by role and username prefix, stream=true exports every match as NDJSON.
+    """
+    if stream:
+        return stream_ndjson(
+            lambda stream_db: _filter_users(stream_db.query(UserItem), role, username),
+            UserItem.id,
+            _user_response,
+        )
 
-    if not users:
+    users = paginate(_filter_users(db.query(UserItem), role, username), UserItem.id, after, limit, response)
+
+    if not users and after is None:
         return {'message': 'No users'}
     
-    user_response = []
-    for user in users:
-        user_response.append({
-            "id": user.id,
-            "username": user.username,
-            "email": user.email,
-            "role": user.role,
-            "password": user.password
-        })
-    
-    return user_response
+    return users
@@ -1,7 +1,9 @@
 from datetime import datetime, timedelta, timezone
 from jose import jwt
+from uuid import uuid4
 import os
 from dotenv import load_dotenv
+from config import ACCESS_TOKEN_EXPIRE_MINUTES
 
 load_dotenv()
 
@@ -11,10 +13,9 @@ if not SECRET_KEY:
     raise ValueError("SECRET_KEY not found in environment variables")
 
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 120
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
-    """Generate a JWT access token."""
+    """Generate a JWT access token. The jti lets this one token be revoked on logout."""
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + (
         expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -22,6 +23,7 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode.update({
         "exp": expire,
         "iat": datetime.now(timezone.utc),
+        "jti": uuid4().hex,
     })
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
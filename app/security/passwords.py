@@ -0,0 +1,71 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+from config import ARGON2_TIME_COST, ARGON2_MEMORY_COST, ARGON2_PARALLELISM, PASSWORD_WORKERS, PASSWORD_MAX_PENDING
+
+# Hashes made with other parameters still verify, and get upgraded on the next login
+pwd_context = CryptContext(
+    schemes=["argon2"],
+    deprecated="auto",
+    argon2__time_cost=ARGON2_TIME_COST,
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__parallelism=ARGON2_PARALLELISM,
+)
+
+
+class PasswordPool:
+    """
+    Argon2 is slow and memory hungry on purpose, so it gets its own few threads
+    (argon2-cffi releases the GIL while hashing) instead of the route threadpool,
+    and only so much of it may wait at once. A burst of logins beyond that is
+    turned away with 503 instead of holding every route thread and
+    PASSWORD_MAX_PENDING * ARGON2_MEMORY_COST of memory.
+    """
+    def __init__(self, workers: int = PASSWORD_WORKERS, max_pending: int = PASSWORD_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="argon2")
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def run(self, fn, *args):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many logins at once, try again",
+                    headers={"Retry-After": "1"},
+                )
+            self.pending += 1
+        try:
+            # The calling route thread waits here, the hashing happens on the pool
+            return self.executor.submit(fn, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def status(self) -> dict:
+        return {
+            "workers": self.executor._max_workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+        }
+
+
+password_pool = PasswordPool()
+
+
+def hash_password(password: str) -> str:
+    return password_pool.run(pwd_context.hash, password)
+
+
+def verify_password(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """
+    Whether the password matches, plus a new hash when the stored one was made with
+    other Argon2 parameters than the current ones (the caller saves it).
+    """
+    return password_pool.run(pwd_context.verify_and_update, password, hashed)
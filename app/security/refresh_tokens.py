@@ -0,0 +1,84 @@
+import hashlib
+import secrets
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+from uuid import uuid4
+from fastapi import HTTPException, status
+from sqlalchemy.orm import Session
+from database.tokens_database import RefreshTokenItem
+from database.users_database import UserItem
+from config import REFRESH_TOKEN_EXPIRE_DAYS
+
+
+def _hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _invalid():
+    return HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+
+
+def issue_refresh_token(db: Session, user_id: int, family_id: Optional[str] = None) -> str:
+    """A new opaque refresh token, a new family unless it replaces one. The caller commits."""
+    token = secrets.token_urlsafe(32)
+    now = datetime.now(timezone.utc)
+    db.add(RefreshTokenItem(
+        user_id=user_id,
+        token_hash=_hash(token),
+        family_id=family_id or uuid4().hex,
+        created_at=now,
+        expires_at=now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    ))
+    return token
+
+
+def _revoke_family(db: Session, family_id: str):
+    db.query(RefreshTokenItem).filter(
+        RefreshTokenItem.family_id == family_id,
+        RefreshTokenItem.revoked_at.is_(None),
+    ).update({"revoked_at": datetime.now(timezone.utc)})
+
+
+def rotate_refresh_token(db: Session, token: str) -> Tuple[UserItem, str]:
+    """
+    Swap a refresh token for a new one of the same family, the old one stops working.
+    A token that was already swapped means it leaked (or was replayed), so the whole
+    family is revoked and both holders have to log in again. The caller commits.
+    """
+    # Locked so two concurrent refreshes with the same token can't both succeed
+    item = db.query(RefreshTokenItem).filter(RefreshTokenItem.token_hash == _hash(token)).with_for_update().first()
+    if not item:
+        raise _invalid()
+
+    if item.revoked_at is not None:
+        _revoke_family(db, item.family_id)
+        db.commit()
+        raise _invalid()
+
+    if item.expires_at <= datetime.now(timezone.utc):
+        raise _invalid()
+
+    user = db.query(UserItem).filter(UserItem.id == item.user_id).first()
+    if not user:
+        raise _invalid()
+
+    item.revoked_at = datetime.now(timezone.utc)
+    return user, issue_refresh_token(db, user.id, item.family_id)
+
+
+def revoke_refresh_token(db: Session, token: str, user_id: int):
+    """Logout: the token's whole family, only if it belongs to the user. The caller commits."""
+    item = db.query(RefreshTokenItem).filter(
+        RefreshTokenItem.token_hash == _hash(token),
+        RefreshTokenItem.user_id == user_id,
+    ).first()
+    if item:
+        _revoke_family(db, item.family_id)
+
+
+def revoke_user_refresh_tokens(db: Session, user_id: int):
+    """Every refresh token of the user, e.g. after a password change. The caller commits."""
+    db.query(RefreshTokenItem).filter(
+        RefreshTokenItem.user_id == user_id,
+        RefreshTokenItem.revoked_at.is_(None),
+    ).update({"revoked_at": datetime.now(timezone.utc)})
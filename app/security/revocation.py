@@ -0,0 +1,154 @@
+import asyncio
+import math
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from database.database import SessionLocal
+from database.tokens_database import TokenRevocationItem
+from config import ACCESS_TOKEN_EXPIRE_MINUTES, REVOCATION_SYNC_INTERVAL
+
+# Rows below the newest one seen that every sync reads again, a revocation whose
+# transaction committed after a later numbered one's would be skipped otherwise
+SYNC_OVERLAP = 100
+
+
+class Revocation(NamedTuple):
+    """The columns of a token_revocations row apply() needs, kept off the row so applying it after the commit doesn't reload it."""
+    jti: Optional[str]
+    user_id: Optional[int]
+    revoked_before: Optional[datetime]
+    expires_at: datetime
+
+
+class RevocationList:
+    """
+    In-memory copy of the unexpired rows of token_revocations: revoked access token
+    jtis, and per user a cutoff before which every token of theirs is revoked. Loaded
+    at startup, then only the rows added since the last look are read every
+    REVOCATION_SYNC_INTERVAL seconds, which is how revocations made on other workers
+    arrive. Entries only live as long as the tokens they cover, so both dicts stay
+    as small as the number of logouts and password changes in one access token lifetime.
+    """
+    def __init__(self, interval: float = REVOCATION_SYNC_INTERVAL):
+        self.interval = interval
+        # jti -> the token's exp
+        self.jtis: Dict[str, float] = {}
+        # str(user id), as in the sub claim -> (tokens issued before this are revoked, entry expires)
+        self.users: Dict[str, Tuple[float, float]] = {}
+        self.last_id = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def is_revoked(self, payload: Dict[str, Any]) -> bool:
+        """Two dictionary lookups, runs on every authenticated request."""
+        if payload.get("jti") in self.jtis:
+            return True
+        cutoff = self.users.get(payload.get("sub"))
+        return cutoff is not None and payload.get("iat", 0) < cutoff[0]
+
+    def _apply(self, row: Union[TokenRevocationItem, Revocation]):
+        expires = row.expires_at.timestamp()
+        if row.jti:
+            self.jtis[row.jti] = expires
+        if row.user_id is not None and row.revoked_before is not None:
+            key = str(row.user_id)
+            cutoff = row.revoked_before.timestamp()
+            if cutoff >= self.users.get(key, (0.0, 0.0))[0]:
+                self.users[key] = (cutoff, expires)
+
+    def _prune(self):
+        # Swapped in whole, is_revoked never sees a dict that is being resized
+        now = time.time()
+        self.jtis = {jti: exp for jti, exp in self.jtis.items() if exp > now}
+        self.users = {user: entry for user, entry in self.users.items() if entry[1] > now}
+
+    def _fetch(self, after: int) -> List[TokenRevocationItem]:
+        db = SessionLocal()
+        try:
+            return (
+                db.query(TokenRevocationItem)
+                .filter(TokenRevocationItem.id > after, TokenRevocationItem.expires_at > datetime.now(timezone.utc))
+                .order_by(TokenRevocationItem.id)
+                .all()
+            )
+        finally:
+            db.close()
+
+    def _delete_expired(self):
+        db = SessionLocal()
+        try:
+            db.query(TokenRevocationItem).filter(TokenRevocationItem.expires_at <= datetime.now(timezone.utc)).delete()
+            db.commit()
+        finally:
+            db.close()
+
+    async def sync(self):
+        rows = await run_in_threadpool(self._fetch, max(0, self.last_id - SYNC_OVERLAP))
+        for row in rows:
+            self._apply(row)
+            self.last_id = max(self.last_id, row.id)
+        self._prune()
+
+    async def start(self):
+        try:
+            await run_in_threadpool(self._delete_expired)
+            await self.sync()
+        except Exception as e:
+            print(f"Could not load the token revocation list: {e}")
+        print(f"Revocation list loaded with {len(self.jtis)} tokens and {len(self.users)} users")
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"Token revocation sync failed: {e}")
+
+    def revoke_token(self, db: Session, payload: Dict[str, Any]) -> Optional[Revocation]:
+        """
+        Revoke one access token (logout). Only adds the row, the caller commits and
+        then passes the result to apply(), so a rolled back revocation never takes effect here.
+        """
+        jti = payload.get("jti")
+        if not jti:
+            return None
+        revocation = Revocation(jti, None, None, datetime.fromtimestamp(payload["exp"], timezone.utc))
+        db.add(TokenRevocationItem(**revocation._asdict()))
+        return revocation
+
+    def revoke_user(self, db: Session, user_id: int) -> Revocation:
+        """
+        Revoke every access token the user has been issued so far (password change,
+        account deletion). Tokens carry whole seconds in iat, so the cutoff is rounded
+        down and a login in the same second still works. Like revoke_token, the caller
+        commits and then applies the result.
+        """
+        revoked_before = datetime.fromtimestamp(math.floor(time.time()), timezone.utc)
+        # No token older than the cutoff outlives this
+        expires = revoked_before + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES, seconds=1)
+        revocation = Revocation(None, user_id, revoked_before, expires)
+        db.add(TokenRevocationItem(**revocation._asdict()))
+        return revocation
+
+    def apply(self, *revocations: Optional[Revocation]):
+        """Committed revocations take effect on this worker at once, other workers pick them up on their next sync."""
+        for revocation in revocations:
+            if revocation is not None:
+                self._apply(revocation)
+
+    def status(self) -> dict:
+        return {"tokens": len(self.jtis), "users": len(self.users), "last_id": self.last_id, "interval": self.interval}
+
+
+revocation_list = RevocationList()
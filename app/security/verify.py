@@ -1,8 +1,15 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import jwt, ExpiredSignatureError, JWTError
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import hashlib
 import os
+import threading
+import time
 from dotenv import load_dotenv
+from config import AUTH_CACHE_SIZE
+from security.revocation import revocation_list
 
 load_dotenv()
 
@@ -14,15 +21,92 @@ security = HTTPBearer()
 if not SECRET_KEY:
     raise ValueError("SECRET_KEY not found in environment variables")
 
-def verify_jwt_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+
+class TokenCache:
+    """
+    LRU of already verified tokens, keyed by a digest of the token (the raw token
+    isn't kept). A hit is a dictionary lookup plus an expiry check against the
+    token's own exp claim, so hot tokens skip decoding and the HMAC check.
+    """
+    def __init__(self, max_entries: int = AUTH_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[bytes, Tuple[Dict[str, Any], Optional[float]]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, expires = entry
+            if expires is not None and expires <= time.time():
+                del self.entries[key]
+                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired")
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, key: bytes, payload: Dict[str, Any]):
+        expires = payload.get("exp")
+        with self.lock:
+            self.entries[key] = (payload, float(expires) if expires is not None else None)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+
+token_cache = TokenCache()
+
+
+def _check_revoked(payload: Dict[str, Any]):
+    # Checked on every use, cached tokens included, revoking doesn't have to touch the cache
+    if revocation_list.is_revoked(payload):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+
+
+def decode_token(token: str) -> Dict[str, Any]:
+    """
+    The verified claims of a token, for HTTP routes and websocket handshakes alike.
+    The returned dict is shared with the cache, don't modify it.
+    """
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    payload = token_cache.get(key)
+    if payload is not None:
+        _check_revoked(payload)
+        return payload
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("sub")
-        if not user_id:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token payload")
-        return payload
     except ExpiredSignatureError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired")
     except JWTError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
\ No newline at end of file
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+
+    if not payload.get("sub"):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token payload")
+
+    token_cache.put(key, payload)
+    _check_revoked(payload)
+    return payload
+
+
+# Async so a cache hit doesn't need a threadpool hop. FastAPI caches dependencies per request,
+# so the router level dependency and a route's `payload` parameter share one verification
+async def verify_jwt_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return decode_token(credentials.credentials)
+
+
+def verify_jwt_token_ws(token: str):
+    """For websocket handshakes, which pass the raw token as a query parameter."""
+    return decode_token(token)
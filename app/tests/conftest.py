@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The app imports its modules top level (from config import ...), as uvicorn runs it from app/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SECRETKEY", "test")
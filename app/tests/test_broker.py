@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+from websocket.broker import Broker, UnixSocketBroker
+
+
+async def _wait_for(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("timed out")
+        await asyncio.sleep(0.02)
+
+
+async def _started(path, received, state=None):
+    broker = UnixSocketBroker(str(path))
+
+    async def handler(room_id, message):
+        received.append(message["seq"])
+
+    await broker.start(handler, (lambda room_id: dict(state or {})))
+    await broker.subscribe("1")
+    return broker
+
+
+def test_broker_publish_is_abstract():
+    with pytest.raises(TypeError):
+        Broker()
+
+
+def test_hub_failover_keeps_room_seq_and_state(tmp_path):
+    async def scenario():
+        path = tmp_path / "broker.sock"
+        seen_a, seen_b = [], []
+        hub = await _started(path, seen_a)
+        await _wait_for(lambda: hub._server is not None and hub._writer is not None)
+        peer = await _started(path, seen_b, {"pulse": 120})
+        await _wait_for(lambda: peer._writer is not None and len(hub._peers) == 2)
+
+        for value in (120, 121):
+            await peer.publish("1", {"data": {"type": "update", "payload": {"id": "pulse", "value": value}}})
+        await _wait_for(lambda: seen_a == [1, 2] and seen_b == [1, 2])
+
+        # The hub's worker goes away, the peer elects itself and seeds the new hub
+        await hub.stop()
+        await _wait_for(lambda: peer._server is not None and peer._writer is not None)
+        assert await peer.snapshot("1") == {"pulse": 120}
+
+        await peer.publish("1", {"data": {"type": "update", "payload": {"id": "pulse", "value": 122}}})
+        await _wait_for(lambda: len(seen_b) == 3)
+        assert seen_b == [1, 2, 3]
+        assert await peer.snapshot("1") == {"pulse": 122}
+        await peer.stop()
+
+    asyncio.run(scenario())
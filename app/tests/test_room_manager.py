@@ -0,0 +1,57 @@
+import asyncio
+import websocket.websocket as ws_module
+from websocket.broker import InProcessBroker
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+        self.scope = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+    async def close(self, code=1000):
+        pass
+
+
+def test_connect_resubscribes_when_the_room_empties_meanwhile(monkeypatch):
+    async def base_values(room_id):
+        return {"pulse": 80}
+
+    monkeypatch.setattr(ws_module, "load_base_values", base_values)
+
+    async def scenario():
+        broker = InProcessBroker()
+        manager = ws_module.RoomManager(broker=broker)
+        manager.recorder.record = lambda *args: None
+        await manager.start()
+
+        first = FakeSocket()
+        await manager.connect(first, "1", "u1")
+
+        room_state = manager._room_state
+
+        async def slow_room_state(room_id, refresh=False):
+            await asyncio.sleep(0.05)
+            return await room_state(room_id, refresh)
+
+        manager._room_state = slow_room_state
+        second = FakeSocket()
+        joining = asyncio.create_task(manager.connect(second, "1", "u2"))
+        await asyncio.sleep(0.01)
+        # The only member leaves while u2 waits, the room is deleted and unsubscribed
+        await manager.disconnect(first, "1", "u1")
+        await joining
+
+        assert "1" in broker.rooms
+        assert "1" not in manager._evictions
+        await manager.handle_message("1", "u3", {"type": "update", "payload": {"id": "pulse", "value": 99}})
+        await asyncio.sleep(0.01)
+        assert '"value":99' in second.sent[-1]
+        await manager.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+from starlette.concurrency import run_in_threadpool
+from database.database import SessionLocal
+from database.simulation_database import SimulationItem
+from constants import RoleEnum
+from config import WS_ADMISSION_TTL, WS_ADMISSION_NEGATIVE_TTL, WS_ADMISSION_MAX_ENTRIES
+
+
+class Admission(NamedTuple):
+    sim_id: int
+    user_id: Optional[int]
+    passphrase_hash: Optional[bytes]
+    active: bool
+    loaded_at: float
+
+
+def _hash(passphrase: str) -> bytes:
+    return hashlib.sha256(passphrase.encode()).digest()
+
+
+def _entry(sim_id: int, sim: Optional[SimulationItem]) -> Admission:
+    # A missing simulation is cached too, so a storm of bad handshakes doesn't hit the database
+    if sim is None:
+        return Admission(sim_id, None, None, False, time.monotonic())
+    return Admission(sim.id, sim.user_id, _hash(sim.passphrase), bool(sim.state), time.monotonic())
+
+
+class AdmissionCache:
+    """
+    In-memory view of which simulations a /ws room can be joined for: id, owner,
+    passphrase hash and state. Warmed at startup and kept current by the simulation
+    routes. The database is only asked when an entry is missing or older than the TTL
+    (WS_ADMISSION_NEGATIVE_TTL for ids that don't exist), which also covers changes
+    made on other workers. LRU bound to max_entries, and concurrent handshakes for
+    the same id share one load.
+    """
+    def __init__(
+        self,
+        ttl: float = WS_ADMISSION_TTL,
+        negative_ttl: float = WS_ADMISSION_NEGATIVE_TTL,
+        max_entries: int = WS_ADMISSION_MAX_ENTRIES,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[int, Admission]" = OrderedDict()
+        # put/invalidate run in the route threadpool, get on the event loop
+        self.lock = threading.Lock()
+        # Bumped by put/invalidate, a load that raced one isn't stored
+        self.generation = 0
+        self._loading: Dict[int, asyncio.Future] = {}
+
+    def _load_active(self):
+        db = SessionLocal()
+        try:
+            return db.query(SimulationItem).filter(SimulationItem.state == True).all()
+        finally:
+            db.close()
+
+    def _load_one(self, sim_id: int) -> Admission:
+        db = SessionLocal()
+        try:
+            return _entry(sim_id, db.query(SimulationItem).filter(SimulationItem.id == sim_id).first())
+        finally:
+            db.close()
+
+    async def warm(self):
+        try:
+            sims = await run_in_threadpool(self._load_active)
+        except Exception as e:
+            print(f"Could not warm the admission cache: {e}")
+            return
+        with self.lock:
+            for sim in sims:
+                self._store(_entry(sim.id, sim))
+        print(f"Admission cache warmed with {len(self.entries)} active simulations")
+
+    def _store(self, entry: Admission):
+        self.entries[entry.sim_id] = entry
+        self.entries.move_to_end(entry.sim_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put(self, sim: SimulationItem):
+        with self.lock:
+            self.generation += 1
+            self._store(_entry(sim.id, sim))
+
+    def invalidate(self, sim_id: int):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(sim_id, None)
+
+    def _fresh(self, entry: Optional[Admission]) -> bool:
+        if entry is None:
+            return False
+        ttl = self.ttl if entry.user_id is not None else self.negative_ttl
+        return time.monotonic() - entry.loaded_at <= ttl
+
+    async def get(self, sim_id: int) -> Admission:
+        with self.lock:
+            entry = self.entries.get(sim_id)
+            if self._fresh(entry):
+                self.entries.move_to_end(sim_id)
+                return entry
+
+        # A reconnect storm for one simulation waits on a single query
+        loading = self._loading.get(sim_id)
+        if loading is not None:
+            return await asyncio.shield(loading)
+
+        loading = self._loading[sim_id] = asyncio.get_running_loop().create_future()
+        try:
+            generation = self.generation
+            entry = await run_in_threadpool(self._load_one, sim_id)
+            with self.lock:
+                if generation == self.generation:
+                    self._store(entry)
+            loading.set_result(entry)
+            return entry
+        except asyncio.CancelledError:
+            loading.cancel()
+            raise
+        except Exception as e:
+            loading.set_exception(e)
+            # Retrieved so a load nobody else waited on isn't logged as unhandled
+            loading.exception()
+            raise
+        finally:
+            del self._loading[sim_id]
+
+    async def admit(self, room_id: str, payload: dict, passphrase: Optional[str]) -> bool:
+        """
+        Whether the token's user may join the room. The room is the simulation id,
+        the simulation has to be active and the passphrase has to match, the owner
+        and admins don't need one.
+        """
+        try:
+            sim_id = int(room_id)
+        except ValueError:
+            return False
+
+        entry = await self.get(sim_id)
+        if not entry.active:
+            return False
+
+        if payload.get("role") == RoleEnum.admin.value or str(entry.user_id) == str(payload.get("sub")):
+            return True
+
+        return passphrase is not None and hmac.compare_digest(entry.passphrase_hash, _hash(passphrase))
+
+
+admission_cache = AdmissionCache()
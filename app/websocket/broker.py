@@ -0,0 +1,523 @@
+import abc
+import asyncio
+import fcntl
+import os
+import struct
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+from urllib.parse import urlparse
+import msgpack
+from config import WS_BROKER, WS_IPC_PATH, WS_REDIS_URL, WS_BROKER_TIMEOUT, WS_ROOM_STATE_TTL
+
+# handler(room_id, message), called for every message published to a room this process subscribed to
+Handler = Callable[[str, Dict[str, Any]], Awaitable[None]]
+# local_state(room_id), the room's current values on this process
+LocalState = Callable[[str], Dict[str, Any]]
+
+
+def state_changes(message: Dict[str, Any]) -> Dict[Any, Any]:
+    """The vital values a published message sets, {id: value}, from an update or a batch."""
+    data = message.get("data", message)
+    if data.get("type") == "update":
+        updates = [data.get("payload")]
+    elif data.get("type") == "batch":
+        updates = data.get("payload") or []
+    else:
+        return {}
+    return {
+        update["id"]: update["value"]
+        for update in updates
+        if isinstance(update, dict) and isinstance(update.get("id"), (str, int)) and "value" in update
+    }
+
+
+class BrokerError(Exception):
+    pass
+
+
+class Broker(abc.ABC):
+    """
+    Pub/sub between RoomManagers. Each process subscribes to the rooms it has
+    local sockets in, and only ever delivers to those sockets.
+    Every delivered message carries a "seq", increasing per room and shared by
+    all subscribers of that room. Brokers shared between workers also keep the
+    rooms' latest values, so a worker that starts serving a room can fetch them.
+    """
+    def __init__(self):
+        self.handler: Optional[Handler] = None
+        self.local_state: Optional[LocalState] = None
+        self.rooms: Set[str] = set()
+        self._seq: Dict[str, int] = {}
+
+    async def start(self, handler: Handler, local_state: Optional[LocalState] = None):
+        self.handler = handler
+        self.local_state = local_state
+
+    async def stop(self):
+        pass
+
+    async def subscribe(self, room_id: str):
+        self.rooms.add(room_id)
+
+    async def unsubscribe(self, room_id: str):
+        self.rooms.discard(room_id)
+
+    @abc.abstractmethod
+    async def publish(self, room_id: str, message: Dict[str, Any]):
+        """Deliver message, stamped with the room's next seq, to every subscriber of the room."""
+
+    async def snapshot(self, room_id: str) -> Dict[Any, Any]:
+        """The room's latest values as every worker published them, empty when only this process knows them."""
+        return {}
+
+    def _next_seq(self, room_id: str) -> int:
+        seq = self._seq.get(room_id, 0) + 1
+        self._seq[room_id] = seq
+        return seq
+
+    async def _dispatch(self, room_id: str, message: Dict[str, Any]):
+        if room_id not in self.rooms or self.handler is None:
+            return
+        try:
+            await self.handler(room_id, message)
+        except Exception as e:
+            print(f"Broker failed to deliver to room {room_id}: {e}")
+
+
+class InProcessBroker(Broker):
+    """Single process, messages go straight to the local sockets."""
+    async def publish(self, room_id: str, message: Dict[str, Any]):
+        message["seq"] = self._next_seq(room_id)
+        await self._dispatch(room_id, message)
+
+
+# Length prefixed msgpack packets for the Unix socket hub
+def _pack(obj: Any) -> bytes:
+    body = msgpack.packb(obj)
+    return struct.pack("!I", len(body)) + body
+
+
+async def _read_packet(reader: asyncio.StreamReader) -> Any:
+    (size,) = struct.unpack("!I", await reader.readexactly(4))
+    return msgpack.unpackb(await reader.readexactly(size))
+
+
+class UnixSocketBroker(Broker):
+    """
+    Multi-worker broker for one host. The first worker to grab the lock file runs a
+    small hub on a Unix domain socket, and every worker (the hub's own included)
+    connects to it as a peer. The hub stamps the room's seq on each publish and
+    relays it to the peers subscribed to that room. If the hub worker dies the
+    others re-elect a new one.
+    """
+    def __init__(self, path: str = WS_IPC_PATH):
+        super().__init__()
+        self.path = path
+        self._lock_fd: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Dict[asyncio.StreamWriter, Set[str]] = {}
+        self._draining: Set[asyncio.StreamWriter] = set()
+        # Hub side, the latest values of every room, kept WS_ROOM_STATE_TTL after its last subscriber left
+        self._state: Dict[str, Dict[Any, Any]] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        # Peer side, snapshot requests waiting for the hub
+        self._requests: Dict[int, asyncio.Future] = {}
+        self._next_request = 0
+
+    async def start(self, handler: Handler, local_state: Optional[LocalState] = None):
+        await super().start(handler, local_state)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self._writer:
+            self._writer.close()
+        if self._server:
+            self._server.close()
+            self._server = None
+            # Closing the server keeps accepted connections open, the peers only re-elect once these go
+            for peer in list(self._peers):
+                peer.close()
+            self._peers.clear()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def subscribe(self, room_id: str):
+        await super().subscribe(room_id)
+        await self._send({"op": "sub", "room": room_id})
+
+    async def unsubscribe(self, room_id: str):
+        await super().unsubscribe(room_id)
+        await self._send({"op": "unsub", "room": room_id})
+
+    async def publish(self, room_id: str, message: Dict[str, Any]):
+        # The message stays packed, the hub only needs the room to route it and the values it sets
+        sent = await self._send({
+            "op": "pub", "room": room_id, "msg": msgpack.packb(message), "set": state_changes(message),
+        })
+        if not sent:
+            # Hub unreachable, at least keep the local sockets up to date
+            message["seq"] = self._next_seq(room_id)
+            await self._dispatch(room_id, message)
+
+    async def snapshot(self, room_id: str) -> Dict[Any, Any]:
+        self._next_request += 1
+        request = self._next_request
+        future = self._requests[request] = asyncio.get_running_loop().create_future()
+        try:
+            if not await self._send({"op": "get", "room": room_id, "req": request}):
+                return {}
+            return await asyncio.wait_for(future, WS_BROKER_TIMEOUT)
+        except asyncio.TimeoutError:
+            return {}
+        finally:
+            self._requests.pop(request, None)
+
+    async def _send(self, packet: Dict[str, Any]) -> bool:
+        writer = self._writer
+        if writer is None or writer.is_closing():
+            return False
+        try:
+            writer.write(_pack(packet))
+            await asyncio.wait_for(writer.drain(), WS_BROKER_TIMEOUT)
+            return True
+        except asyncio.TimeoutError:
+            # The hub stopped reading, reconnect
+            writer.close()
+            return False
+        except (ConnectionError, OSError):
+            return False
+
+    async def _run(self):
+        # Peer side, (re)connects to the hub and delivers what it relays
+        while True:
+            try:
+                await self._become_hub()
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(0.5)
+                continue
+
+            self._writer = writer
+            try:
+                for room_id in list(self.rooms):
+                    writer.write(_pack({"op": "sub", "room": room_id}))
+                    # A newly elected hub starts empty, hand it what this worker knows. With the
+                    # seq it carries on where the old hub stopped, resumes by last_seq keep working
+                    writer.write(_pack({
+                        "op": "seed",
+                        "room": room_id,
+                        "seq": self._seq.get(room_id, 0),
+                        "state": self.local_state(room_id) if self.local_state is not None else {},
+                    }))
+                await asyncio.wait_for(writer.drain(), WS_BROKER_TIMEOUT)
+
+                # The hub can stay quiet for as long as nothing is published, no read timeout here.
+                # It's on this host, a dead hub closes the socket
+                while True:
+                    packet = await _read_packet(reader)
+                    if "req" in packet:
+                        future = self._requests.get(packet["req"])
+                        if future is not None and not future.done():
+                            future.set_result(packet["state"])
+                        continue
+                    message = msgpack.unpackb(packet["msg"])
+                    message["seq"] = packet["seq"]
+                    self._seq[packet["room"]] = max(self._seq.get(packet["room"], 0), packet["seq"])
+                    await self._dispatch(packet["room"], message)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                print("IPC broker lost the hub, reconnecting")
+            finally:
+                self._writer = None
+                writer.close()
+                for future in self._requests.values():
+                    if not future.done():
+                        future.set_result({})
+
+    async def _become_hub(self):
+        if self._server is not None:
+            return
+
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another worker is the hub
+            os.close(fd)
+            return
+
+        self._lock_fd = fd
+        # Whatever socket file is left belongs to a dead hub
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve_peer, path=self.path)
+        print(f"IPC broker hub listening on {self.path} (pid {os.getpid()})")
+
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        rooms = self._peers[writer] = set()
+        try:
+            while True:
+                packet = await _read_packet(reader)
+                op = packet["op"]
+                if op == "sub":
+                    rooms.add(packet["room"])
+                elif op == "unsub":
+                    rooms.discard(packet["room"])
+                    self._expire_state_later(packet["room"])
+                elif op == "get":
+                    writer.write(_pack({"req": packet["req"], "state": self._state.get(packet["room"], {})}))
+                elif op == "seed":
+                    room_id = packet["room"]
+                    self._seq[room_id] = max(self._seq.get(room_id, 0), packet.get("seq", 0))
+                    state = self._state.setdefault(room_id, {})
+                    for key, value in packet["state"].items():
+                        state.setdefault(key, value)
+                elif op == "pub":
+                    if packet.get("set"):
+                        self._state.setdefault(packet["room"], {}).update(packet["set"])
+                    seq = self._next_seq(packet["room"])
+                    data = _pack({"room": packet["room"], "seq": seq, "msg": packet["msg"]})
+                    for peer, peer_rooms in list(self._peers.items()):
+                        if packet["room"] in peer_rooms:
+                            peer.write(data)
+                            # Drained on the side so one slow peer doesn't hold up the rest
+                            if peer.transport.get_write_buffer_size() and peer not in self._draining:
+                                self._draining.add(peer)
+                                asyncio.create_task(self._drain_peer(peer))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._peers.pop(writer, None)
+            writer.close()
+            for room_id in rooms:
+                self._expire_state_later(room_id)
+
+    def _expire_state_later(self, room_id: str):
+        asyncio.get_running_loop().call_later(WS_ROOM_STATE_TTL, self._expire_state, room_id)
+
+    def _expire_state(self, room_id: str):
+        # Only once no worker has subscribed to the room again
+        if not any(room_id in rooms for rooms in self._peers.values()):
+            self._state.pop(room_id, None)
+
+    async def _drain_peer(self, peer: asyncio.StreamWriter):
+        """A peer that can't take what it's sent within the timeout is cut off, its buffer doesn't grow without bound."""
+        try:
+            await asyncio.wait_for(peer.drain(), WS_BROKER_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            if self._peers.pop(peer, None) is not None:
+                print("IPC broker hub dropped a peer that stopped reading")
+            # Its worker sees the closed socket and reconnects
+            peer.close()
+        finally:
+            self._draining.discard(peer)
+
+
+# Minimal RESP (Redis protocol) client helpers
+def _command(*args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader) -> Any:
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Redis connection closed")
+
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        raise BrokerError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        size = int(rest)
+        if size == -1:
+            return None
+        return (await reader.readexactly(size + 2))[:-2]
+    if kind == b"*":
+        size = int(rest)
+        if size == -1:
+            return None
+        return [await _read_reply(reader) for _ in range(size)]
+    raise ConnectionError(f"Unexpected Redis reply: {line!r}")
+
+
+# Bumps the room's seq, stores the values the message sets (ARGV[2..], field value pairs)
+# in the room's state hash and publishes "<seq>\n<message>", all in one atomic step
+_PUBLISH_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], 86400)
+if #ARGV > 1 then
+    redis.call('HSET', KEYS[3], unpack(ARGV, 2))
+    redis.call('EXPIRE', KEYS[3], 86400)
+end
+redis.call('PUBLISH', KEYS[2], seq .. '\\n' .. ARGV[1])
+return seq
+"""
+
+
+class RedisBroker(Broker):
+    """
+    Multi-host broker that speaks the Redis protocol (RESP) directly, so any Redis
+    compatible server works. One connection publishes, a second one holds the
+    subscriptions for the rooms this process has sockets in. Room seqs live in
+    Redis, so every worker agrees on them.
+    """
+    def __init__(self, url: str = WS_REDIS_URL, prefix: str = "beds2bytes:room:"):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.username = parsed.username
+        self.password = parsed.password
+        self.prefix = prefix
+        self._pub: Optional[tuple] = None
+        self._pub_lock = asyncio.Lock()
+        self._sub_writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _channel(self, room_id: str) -> str:
+        return self.prefix + room_id
+
+    async def _open(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), WS_BROKER_TIMEOUT)
+        if self.password:
+            auth = [self.username, self.password] if self.username else [self.password]
+            writer.write(_command("AUTH", *auth))
+            await asyncio.wait_for(_read_reply(reader), WS_BROKER_TIMEOUT)
+        return reader, writer
+
+    async def start(self, handler: Handler, local_state: Optional[LocalState] = None):
+        await super().start(handler, local_state)
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self._sub_writer:
+            self._sub_writer.close()
+        if self._pub:
+            self._pub[1].close()
+            self._pub = None
+
+    async def subscribe(self, room_id: str):
+        await super().subscribe(room_id)
+        await self._sub_command("SUBSCRIBE", self._channel(room_id))
+
+    async def unsubscribe(self, room_id: str):
+        await super().unsubscribe(room_id)
+        await self._sub_command("UNSUBSCRIBE", self._channel(room_id))
+
+    async def _sub_command(self, *args):
+        writer = self._sub_writer
+        if writer is None:
+            return
+        try:
+            writer.write(_command(*args))
+            await asyncio.wait_for(writer.drain(), WS_BROKER_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            # _listen notices the closed connection, reconnects and resubscribes every room
+            writer.close()
+
+    async def publish(self, room_id: str, message: Dict[str, Any]):
+        async with self._pub_lock:
+            try:
+                if self._pub is None:
+                    self._pub = await self._open()
+                reader, writer = self._pub
+                # Ids and values are packed, a vital id doesn't have to be a string
+                fields = [
+                    part for key, value in state_changes(message).items()
+                    for part in (msgpack.packb(key), msgpack.packb(value))
+                ]
+                writer.write(_command(
+                    "EVAL", _PUBLISH_SCRIPT, "3",
+                    self.prefix + "seq:" + room_id, self._channel(room_id), self.prefix + "state:" + room_id,
+                    msgpack.packb(message), *fields,
+                ))
+                await asyncio.wait_for(_read_reply(reader), WS_BROKER_TIMEOUT)
+                return
+            except (OSError, ConnectionError, BrokerError, asyncio.TimeoutError) as e:
+                print(f"Redis publish failed: {type(e).__name__} {e}")
+                if self._pub:
+                    self._pub[1].close()
+                self._pub = None
+
+        # Redis unreachable, at least keep the local sockets up to date
+        message["seq"] = self._next_seq(room_id)
+        await self._dispatch(room_id, message)
+
+    async def snapshot(self, room_id: str) -> Dict[Any, Any]:
+        async with self._pub_lock:
+            try:
+                if self._pub is None:
+                    self._pub = await self._open()
+                reader, writer = self._pub
+                writer.write(_command("HGETALL", self.prefix + "state:" + room_id))
+                reply = await asyncio.wait_for(_read_reply(reader), WS_BROKER_TIMEOUT) or []
+            except (OSError, ConnectionError, BrokerError, asyncio.TimeoutError) as e:
+                print(f"Redis room state read failed: {type(e).__name__} {e}")
+                if self._pub:
+                    self._pub[1].close()
+                self._pub = None
+                return {}
+        return {msgpack.unpackb(reply[i]): msgpack.unpackb(reply[i + 1]) for i in range(0, len(reply), 2)}
+
+    async def _listen(self):
+        while True:
+            try:
+                reader, writer = await self._open()
+            except (OSError, asyncio.TimeoutError, BrokerError) as e:
+                print(f"Redis broker can't connect: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            self._sub_writer = writer
+            if self.rooms:
+                writer.write(_command("SUBSCRIBE", *[self._channel(r) for r in self.rooms]))
+
+            try:
+                await asyncio.wait_for(writer.drain(), WS_BROKER_TIMEOUT)
+                pinged = False
+                while True:
+                    # A quiet subscription is normal, so silence gets a PING first.
+                    # No answer to that either and the connection is taken for dead
+                    try:
+                        reply = await asyncio.wait_for(_read_reply(reader), WS_BROKER_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        if pinged:
+                            raise ConnectionError("no reply to PING")
+                        pinged = True
+                        writer.write(_command("PING"))
+                        await asyncio.wait_for(writer.drain(), WS_BROKER_TIMEOUT)
+                        continue
+                    pinged = False
+                    if isinstance(reply, list) and reply[0] == b"message":
+                        room_id = reply[1].decode()[len(self.prefix):]
+                        seq, body = reply[2].split(b"\n", 1)
+                        message = msgpack.unpackb(body)
+                        message["seq"] = int(seq)
+                        await self._dispatch(room_id, message)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, OSError, BrokerError) as e:
+                print(f"Redis broker lost its subscription connection: {e}")
+            finally:
+                self._sub_writer = None
+                writer.close()
+            await asyncio.sleep(1)
+
+
+def create_broker(kind: str = WS_BROKER) -> Broker:
+    """Pick the broker from WS_BROKER: "memory" (default), "ipc" or "redis"."""
+    if kind == "ipc":
+        return UnixSocketBroker()
+    if kind == "redis":
+        return RedisBroker()
+    return InProcessBroker()
@@ -0,0 +1,87 @@
+from typing import Any, Dict
+import orjson
+import msgpack
+from fastapi import WebSocket, WebSocketDisconnect
+
+# Wire formats a connection can speak
+JSON = "json"
+MSGPACK = "msgpack"
+
+# Subprotocol clients offer in the /ws handshake (Sec-WebSocket-Protocol) to get binary MessagePack frames
+MSGPACK_SUBPROTOCOL = "beds2bytes.msgpack"
+
+
+class InvalidMessage(ValueError):
+    """A client message that can't be decoded, or can't be sent on to JSON clients and the event log."""
+
+
+class Frame:
+    """
+    A message to broadcast. It is encoded at most once per wire format,
+    no matter how many sockets receive it.
+    """
+    __slots__ = ("data", "_encoded")
+
+    def __init__(self, data: Dict[str, Any]):
+        self.data = data
+        self._encoded: Dict[str, Any] = {}
+
+    def encoded(self, codec: str):
+        buffer = self._encoded.get(codec)
+        if buffer is None:
+            buffer = encode(self.data, codec)
+            self._encoded[codec] = buffer
+        return buffer
+
+
+def encode(data: Any, codec: str):
+    """JSON is sent as a text frame (str), MessagePack as a binary frame (bytes)."""
+    if codec == MSGPACK:
+        return msgpack.packb(data)
+    return orjson.dumps(data).decode()
+
+
+def negotiate(websocket: WebSocket) -> str:
+    """Pick the wire format from the subprotocols the client offered, JSON by default."""
+    if MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", []):
+        return MSGPACK
+    return JSON
+
+
+async def receive(websocket: WebSocket) -> Any:
+    """Receive one message in whichever format the client sent it."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+
+    try:
+        if message.get("bytes") is not None:
+            data = msgpack.unpackb(message["bytes"], raw=False)
+            # MessagePack can carry what JSON can't (bin, ext, non-string keys). Every message
+            # is relayed to JSON clients and stored as JSONB, so it must survive a JSON encode
+            orjson.dumps(data)
+        else:
+            data = orjson.loads(message["text"])
+    except (ValueError, TypeError, msgpack.UnpackException) as e:
+        raise InvalidMessage(str(e)) from e
+
+    _check_shape(data)
+    return data
+
+
+def _check_shape(data: Any):
+    # The room keys state and tickers by the payload id, it has to be a plain hashable scalar
+    if not isinstance(data, dict):
+        raise InvalidMessage("A message must be an object")
+    payload = data.get("payload", data)
+    if isinstance(payload, dict) and "id" in payload:
+        vital_id = payload["id"]
+        if isinstance(vital_id, bool) or not isinstance(vital_id, (str, int)):
+            raise InvalidMessage("payload.id must be a string or an integer")
+
+
+async def send(websocket: WebSocket, buffer):
+    if isinstance(buffer, bytes):
+        await websocket.send_bytes(buffer)
+    else:
+        await websocket.send_text(buffer)
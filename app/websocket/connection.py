@@ -0,0 +1,144 @@
+import asyncio
+from collections import deque
+from typing import Deque, FrozenSet, Optional
+from fastapi import WebSocket
+from config import WS_SEND_QUEUE_SIZE, WS_SLOW_CONSUMER_POLICY
+from .codec import Frame, JSON, send
+from .topics import ALL
+
+# Frames carrying values by id, a full queue may drop one once a newer frame carries
+# all of its ids again. Snapshots, alarms, notes and the like have to arrive
+DROPPABLE_TYPES = frozenset({"update", "batch"})
+
+
+def _update_ids(frame: Frame) -> Optional[FrozenSet]:
+    """The ids an update or batch frame sets, None for any other frame."""
+    data = frame.data
+    if data.get("type") not in DROPPABLE_TYPES:
+        return None
+    payload = data.get("payload")
+    try:
+        if isinstance(payload, list):
+            return frozenset(item["id"] for item in payload)
+        return frozenset((payload["id"],))
+    except (KeyError, TypeError):
+        return None
+
+
+class Connection:
+    """
+    A single websocket connection with its own bounded outbound queue.
+    A writer task drains the queue, so a slow client only ever stalls itself.
+    """
+    def __init__(
+        self,
+        websocket: WebSocket,
+        room_id: str,
+        user_id: str,
+        codec: str = JSON,
+        topics: FrozenSet[str] = frozenset({ALL}),
+        max_queue: int = WS_SEND_QUEUE_SIZE,
+        policy: str = WS_SLOW_CONSUMER_POLICY,
+    ):
+        self.websocket = websocket
+        self.room_id = room_id
+        self.user_id = user_id
+        self.codec = codec
+        self.topics = topics
+        self.policy = policy
+        self.max_queue = max_queue
+        self.queue: Deque[Frame] = deque()
+        self._ready = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+        self._writer: Optional[asyncio.Task] = None
+
+    def wants(self, topic: Optional[str]) -> bool:
+        return topic is None or ALL in self.topics or topic in self.topics
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def send(self, frame: Frame) -> bool:
+        """
+        Enqueue a frame without blocking.
+        Returns False if the connection is closed or was dropped as a slow consumer.
+        """
+        if self.closed:
+            return False
+
+        if len(self.queue) < self.max_queue:
+            self._enqueue(frame)
+            return True
+
+        if self.policy != "disconnect" and self._coalesce(frame):
+            self._enqueue(frame)
+            self.dropped += 1
+            return True
+
+        # Told to, or dropping anything would lose a value. The client reconnects and resyncs from the snapshot
+        print(f"{self.user_id} in room {self.room_id} is too slow, disconnecting")
+        self.close(code=1013)  # Try again later
+        return False
+
+    def _enqueue(self, frame: Frame):
+        self.queue.append(frame)
+        self._ready.set()
+
+    def _coalesce(self, frame: Frame) -> bool:
+        """
+        Drop the oldest queued update whose every id a later queued frame, or frame,
+        sets again, so the client still ends up with the latest value of each id.
+        False when there is none.
+        """
+        # Ids set after the queue position being looked at, walking from the newest
+        covered = set(_update_ids(frame) or ())
+        oldest = None
+        for i in range(len(self.queue) - 1, -1, -1):
+            ids = _update_ids(self.queue[i])
+            if ids is None:
+                continue
+            if ids <= covered:
+                oldest = i
+            covered |= ids
+        if oldest is None:
+            return False
+        del self.queue[oldest]
+        return True
+
+    async def _write_loop(self):
+        try:
+            while True:
+                while not self.queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                frame = self.queue.popleft()
+                # The first writer to reach a frame encodes it, the rest reuse the buffer
+                await send(self.websocket, frame.encoded(self.codec))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Failed to send to {self.user_id} in room {self.room_id}: {e}")
+            # Close the socket so the reader loop ends and the room forgets this connection
+            self.closed = True
+            self.queue.clear()
+            await self._close_socket(1011)
+
+    def close(self, code: int = 1000):
+        """Stop the writer and close the socket, the reader loop then sees the disconnect."""
+        if self.closed:
+            return
+        self.stop()
+        asyncio.create_task(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stop(self):
+        """Stop the writer task, anything still queued is discarded."""
+        self.closed = True
+        if self._writer and not self._writer.done():
+            self._writer.cancel()
@@ -0,0 +1,69 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from sqlalchemy import insert
+from starlette.concurrency import run_in_threadpool
+from database.database import SessionLocal
+from database.events_database import SimulationEventItem
+from config import EVENT_LOG_BATCH_SIZE, EVENT_LOG_FLUSH_INTERVAL
+
+
+def _write(rows: List[Dict[str, Any]]):
+    db = SessionLocal()
+    try:
+        # One executemany, sent as multi-row INSERTs
+        db.execute(insert(SimulationEventItem), rows)
+        db.commit()
+    finally:
+        db.close()
+
+
+class EventRecorder:
+    """
+    Buffers room events in memory and writes them to the event log in batches,
+    when the buffer reaches batch_size or every flush_interval seconds.
+    """
+    def __init__(self, batch_size: int = EVENT_LOG_BATCH_SIZE, flush_interval: float = EVENT_LOG_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # If the database is down, keep at most this many events and drop the oldest
+        self.max_buffer = batch_size * 20
+        self.buffer: List[Dict[str, Any]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Task] = None
+
+    def record(self, room_id: str, data: Dict[str, Any]):
+        self.buffer.append({
+            "room_id": room_id,
+            "seq": data.get("seq"),
+            "type": data.get("type", "update"),
+            "user_id": data.get("from"),
+            "payload": data.get("payload"),
+            "created_at": datetime.now(timezone.utc),
+        })
+        if len(self.buffer) >= self.batch_size and (self._flushing is None or self._flushing.done()):
+            self._flushing = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        rows, self.buffer = self.buffer, []
+        try:
+            await run_in_threadpool(_write, rows)
+        except Exception as e:
+            print(f"Event log flush of {len(rows)} events failed: {e}")
+            # Put them back in front, they go out with the next flush
+            self.buffer = (rows + self.buffer)[-self.max_buffer:]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        await self.flush()
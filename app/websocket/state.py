@@ -0,0 +1,34 @@
+from typing import Any, Dict
+from starlette.concurrency import run_in_threadpool
+from database.database import SessionLocal
+from database.simulation_database import SimulationItem
+from database.cases_database import CaseItem
+
+
+def _load_base_values(room_id: str) -> Dict[str, Any]:
+    # Rooms are named after the simulation id
+    try:
+        sim_id = int(room_id)
+    except ValueError:
+        return {}
+
+    db = SessionLocal()
+    try:
+        base_values = (
+            db.query(CaseItem.base_values)
+            .join(SimulationItem, SimulationItem.case_id == CaseItem.id)
+            .filter(SimulationItem.id == sim_id)
+            .scalar()
+        )
+        return dict(base_values or {})
+    finally:
+        db.close()
+
+
+async def load_base_values(room_id: str) -> Dict[str, Any]:
+    """The starting vitals for a room, from the base_values of its simulation's case."""
+    try:
+        return await run_in_threadpool(_load_base_values, room_id)
+    except Exception as e:
+        print(f"Could not load base values for room {room_id}: {e}")
+        return {}
@@ -0,0 +1,43 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# (user_id, payload, topic), one sender's latest update of a payload id and the named
+# channel it was sent to (None routes it by the id's prefix)
+Pending = Tuple[str, Dict[str, Any], Optional[str]]
+# flush(room_id, updates), called at most once per tick with everything pending in the room
+Flush = Callable[[str, List[Pending]], Awaitable[None]]
+
+
+class RoomTicker:
+    """
+    Coalesces the high-frequency updates of one room. Updates are kept last
+    write wins per payload id, whoever sent them, and flushed together as one
+    frame every tick. The first update after a quiet period goes out right away,
+    and the task exits again once a tick finds nothing pending.
+    """
+    def __init__(self, room_id: str, hz: float, flush: Flush):
+        self.room_id = room_id
+        self.interval = 1 / hz
+        self.flush = flush
+        # pending[payload_id] = (user_id, payload, topic)
+        self.pending: Dict[Any, Pending] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, user_id: str, payload: Dict[str, Any], topic: Optional[str] = None):
+        self.pending[payload["id"]] = (user_id, payload, topic)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.pending:
+            pending, self.pending = self.pending, {}
+            try:
+                await self.flush(self.room_id, list(pending.values()))
+            except Exception as e:
+                print(f"Tick flush failed in room {self.room_id}: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        self.pending.clear()
+        if self._task and not self._task.done():
+            self._task.cancel()
@@ -0,0 +1,31 @@
+from typing import Any, FrozenSet, Optional
+
+# Subscribing to this (the default) gets every message in the room
+ALL = "*"
+
+
+def parse_topics(raw: Optional[str]) -> FrozenSet[str]:
+    """
+    The topics a client asked for when joining, e.g. /ws?...&topics=nurse,vitals.
+    Nothing given means everything.
+    """
+    topics = frozenset(t.strip() for t in (raw or "").split(",") if t.strip())
+    if not topics or ALL in topics:
+        return frozenset({ALL})
+    return topics
+
+
+def topic_of_id(payload_id: Any) -> Optional[str]:
+    """An id like "nurse.wound_care" belongs to the nurse topic, ids without a prefix go to everyone."""
+    if isinstance(payload_id, str) and "." in payload_id:
+        return payload_id.split(".", 1)[0]
+    return None
+
+
+def topic_of(message: Any, payload: Any) -> Optional[str]:
+    """A named channel ("topic" on the message) wins over the payload id prefix."""
+    if isinstance(message, dict) and message.get("topic"):
+        return str(message["topic"])
+    if isinstance(payload, dict):
+        return topic_of_id(payload.get("id"))
+    return None
@@ -0,0 +1,203 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import numpy as np
+from config import WS_TREND_HZ
+
+# emit(room_id, updates), called once per tick for every room whose trended vitals changed
+Emit = Callable[[str, List[Dict[str, Any]]], Awaitable[None]]
+
+LINEAR = 0
+EXPONENTIAL = 1
+SHAPES = {"linear": LINEAR, "exp": EXPONENTIAL, "exponential": EXPONENTIAL}
+
+# Per slot arrays, one slot per (room, vital) with a trend
+_FIELDS = {
+    "start": np.float64,
+    "target": np.float64,
+    "t0": np.float64,
+    "duration": np.float64,
+    "noise": np.float64,
+    "scale": np.float64,  # 10 ** decimals, values are rounded to it
+    "last": np.float64,   # last emitted value, only changes are sent
+    "shape": np.int8,
+    "room": np.int64,
+    "active": np.bool_,
+}
+
+
+class TrendEngine:
+    """
+    Server side vitals. A teacher sets a trend (e.g. pulse 80 -> 130 over 5 minutes
+    with noise) and the engine moves the value there on its own. The trends of
+    every room live in one set of NumPy arrays and a single task steps them all
+    together each tick, so the cost grows with the number of changed values
+    rather than a Python loop per room per vital.
+    """
+    def __init__(self, emit: Emit, hz: float = WS_TREND_HZ, capacity: int = 256, seed: Optional[int] = None):
+        self.emit = emit
+        self.interval = 1 / hz
+        self.rng = np.random.default_rng(seed)
+        self.arrays = {name: np.zeros(capacity, dtype=dtype) for name, dtype in _FIELDS.items()}
+        self.size = 0
+        self.free: List[int] = []
+        self.slots: Dict[Tuple[str, str], int] = {}
+        self.vital_ids: List[Optional[str]] = []
+        # Rooms are numbered so the arrays can group by them
+        self.room_numbers: Dict[str, int] = {}
+        self.room_ids: List[str] = []
+        self.room_slots: Dict[str, Set[int]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def set_trend(
+        self,
+        room_id: str,
+        vital_id: str,
+        start: float,
+        target: float,
+        duration: float,
+        shape: str = "linear",
+        noise: float = 0.0,
+        decimals: int = 0,
+    ):
+        if shape not in SHAPES:
+            raise ValueError(f"Unknown trend shape {shape!r}")
+
+        slot = self.slots.get((room_id, vital_id))
+        if slot is None:
+            slot = self._take_slot(room_id, vital_id)
+
+        a = self.arrays
+        a["start"][slot] = start
+        a["target"][slot] = target
+        a["t0"][slot] = time.monotonic()
+        a["duration"][slot] = max(duration, 1e-3)
+        a["noise"][slot] = noise
+        a["scale"][slot] = 10 ** decimals
+        a["last"][slot] = np.nan
+        a["shape"][slot] = SHAPES[shape]
+        a["active"][slot] = True
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop_trend(self, room_id: str, vital_id: str):
+        slot = self.slots.pop((room_id, vital_id), None)
+        if slot is None:
+            return
+        self.arrays["active"][slot] = False
+        self.vital_ids[slot] = None
+        self.room_slots.get(room_id, set()).discard(slot)
+        self.free.append(slot)
+
+    def clear_room(self, room_id: str):
+        for slot in list(self.room_slots.pop(room_id, ())):
+            vital_id = self.vital_ids[slot]
+            if vital_id is not None:
+                self.stop_trend(room_id, vital_id)
+
+    def _take_slot(self, room_id: str, vital_id: str) -> int:
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = self.size
+            self.size += 1
+            self.vital_ids.append(None)
+            if slot >= len(self.arrays["active"]):
+                self.arrays = {
+                    name: np.concatenate([array, np.zeros(len(array), dtype=array.dtype)])
+                    for name, array in self.arrays.items()
+                }
+
+        number = self.room_numbers.get(room_id)
+        if number is None:
+            number = self.room_numbers[room_id] = len(self.room_ids)
+            self.room_ids.append(room_id)
+
+        self.arrays["room"][slot] = number
+        self.vital_ids[slot] = vital_id
+        self.slots[(room_id, vital_id)] = slot
+        self.room_slots.setdefault(room_id, set()).add(slot)
+        return slot
+
+    def step(self, now: Optional[float] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """Advance every active trend to now, returns the changed values grouped by room."""
+        a = self.arrays
+        active = np.flatnonzero(a["active"][:self.size])
+        if not active.size:
+            return {}
+
+        now = time.monotonic() if now is None else now
+        start = a["start"][active]
+        target = a["target"][active]
+        frac = np.clip((now - a["t0"][active]) / a["duration"][active], 0.0, 1.0)
+
+        linear = start + (target - start) * frac
+        # Within 1% of the target when the duration is up
+        exponential = target + (start - target) * np.exp(-5.0 * frac)
+        value = np.where(a["shape"][active] == EXPONENTIAL, exponential, linear)
+
+        done = frac >= 1.0
+        value = np.where(done, target, value + a["noise"][active] * self.rng.standard_normal(active.size))
+
+        scale = a["scale"][active]
+        value = np.round(value * scale) / scale
+
+        # A slot that went non-finite (overflowing noise or bounds) is dropped, the rest carry on
+        broken = ~np.isfinite(value)
+        if broken.any():
+            for slot in active[broken].tolist():
+                room_id, vital_id = self.room_ids[a["room"][slot]], self.vital_ids[slot]
+                print(f"Trend for {vital_id} in room {room_id} gave a non-finite value, stopped")
+                self.stop_trend(room_id, vital_id)
+            keep = ~broken
+            active, value, scale, done = active[keep], value[keep], scale[keep], done[keep]
+
+        changed = value != a["last"][active]
+        a["last"][active] = value
+
+        updates: Dict[str, List[Dict[str, Any]]] = {}
+        slots = active[changed]
+        if slots.size:
+            values = value[changed]
+            whole = scale[changed] == 1
+
+            # Group the changed slots by room
+            order = np.argsort(a["room"][slots], kind="stable")
+            slots, values, whole = slots[order], values[order], whole[order]
+            rooms, starts = np.unique(a["room"][slots], return_index=True)
+            bounds = starts.tolist()[1:] + [slots.size]
+
+            vital_ids = [self.vital_ids[slot] for slot in slots.tolist()]
+            values = values.tolist()
+            whole = whole.tolist()
+            for room, begin, end in zip(rooms.tolist(), starts.tolist(), bounds):
+                updates[self.room_ids[room]] = [
+                    {"id": vital_ids[i], "value": int(values[i]) if whole[i] else values[i]}
+                    for i in range(begin, end)
+                ]
+
+        # Finished trends hold their target, the slot is free for the next one
+        for slot in active[done].tolist():
+            self.stop_trend(self.room_ids[a["room"][slot]], self.vital_ids[slot])
+
+        return updates
+
+    async def _run(self):
+        while self.slots:
+            try:
+                stepped = self.step()
+            except Exception as e:
+                print(f"Trend engine tick failed: {e}")
+                stepped = {}
+            # One room failing to emit doesn't keep the others from theirs
+            for room_id, updates in stepped.items():
+                try:
+                    await self.emit(room_id, updates)
+                except Exception as e:
+                    print(f"Trend emit failed in room {room_id}: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
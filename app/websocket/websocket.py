@@ -1,85 +1,487 @@
-from typing import Dict, Any, Optional
+import asyncio
+import math
+from collections import deque
+from uuid import uuid4
+from typing import Deque, Dict, Any, FrozenSet, List, Optional, Tuple, Union
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query, HTTPException
-from .auth import verify_jwt_token_ws  # expects a raw token string
+from security.verify import verify_jwt_token_ws  # expects a raw token string
+from .connection import Connection
+from .codec import Frame, InvalidMessage, MSGPACK, MSGPACK_SUBPROTOCOL, negotiate, receive
+from .broker import Broker, create_broker, state_changes
+from .state import load_base_values
+from .ticker import RoomTicker
+from .topics import ALL, parse_topics, topic_of, topic_of_id
+from .trends import TrendEngine
+from .recorder import EventRecorder
+from .admission import admission_cache
+from config import WS_TICK_HZ, WS_HISTORY_SIZE, WS_ROOM_STATE_TTL
 
 router = APIRouter()
 
+# Trend values are rounded to at most this many decimals
+MAX_TREND_DECIMALS = 6
+
 
 class RoomManager:
     """
-    Manages all rooms and connections.
+    Manages all rooms and the connections local to this process.
+    Messages go out through the broker, so users on other workers see them too.
     """
-    def __init__(self):
-        # rooms[room_id] = { user_id: WebSocket, ... }
-        self.rooms: Dict[str, Dict[str, WebSocket]] = {}
+    def __init__(
+        self,
+        broker: Optional[Broker] = None,
+        tick_hz: float = WS_TICK_HZ,
+        history_size: int = WS_HISTORY_SIZE,
+    ):
+        # rooms[room_id] = { user_id: Connection, ... }
+        self.rooms: Dict[str, Dict[str, Connection]] = {}
+        # subscribers[room_id][topic] = { user_id: Connection, ... }, kept up to date on join/leave
+        self.subscribers: Dict[str, Dict[str, Dict[str, Connection]]] = {}
+        # state[room_id] = { vital_id: value, ... }, this worker's copy of each room's values. Kept
+        # WS_ROOM_STATE_TTL after the room's last local user left, shared brokers also hold them for every worker
+        self.state: Dict[str, Dict[str, Any]] = {}
+        self._seeding: Dict[str, asyncio.Task] = {}
+        # Ids set while a room's state was being loaded, those win over what the load returns
+        self._touched: Dict[str, set] = {}
+        self._evictions: Dict[str, asyncio.TimerHandle] = {}
+        # With a tick rate set, updates are coalesced per room instead of sent one by one
+        self.tick_hz = tick_hz
+        self.tickers: Dict[str, RoomTicker] = {}
+        # Latest seq seen per room and a ring buffer of recent broadcasts for resuming clients
+        self.seq: Dict[str, int] = {}
+        self.history: Dict[str, Deque[Tuple[int, Frame]]] = {}
+        self.history_size = history_size
+        # Server side trends, stepped for every room at once
+        self.engine = TrendEngine(self._emit_trends)
+        # Every event is persisted once, by the worker it was published from
+        self.worker_id = uuid4().hex
+        self.recorder = EventRecorder()
+        self.broker = broker or create_broker()
 
-    async def connect(self, websocket: WebSocket, room_id: str, user_id: str):
-        await websocket.accept()
+    async def start(self):
+        self.recorder.start()
+        await self.broker.start(self._deliver, local_state=lambda room_id: self.state.get(room_id, {}))
 
-        if room_id not in self.rooms:
-            self.rooms[room_id] = {}
+    async def stop(self):
+        self.engine.stop()
+        await self.broker.stop()
+        await self.recorder.stop()
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        room_id: str,
+        user_id: str,
+        last_seq: Optional[int] = None,
+        topics: Optional[str] = None,
+    ):
+        codec = negotiate(websocket)
+        await websocket.accept(subprotocol=MSGPACK_SUBPROTOCOL if codec == MSGPACK else None)
+
+        subscribing = await self._open_room(room_id)
+        # Just subscribed, other workers may have moved the room on since this one last saw it
+        state = await self._room_state(room_id, refresh=subscribing)
+        # The last member may have left while this waited, deleting the room and its subscription
+        while room_id not in self.rooms:
+            await self._open_room(room_id)
+            state = await self._room_state(room_id, refresh=True)
+
+        # A reconnect replaces the previous socket of the same user
+        room = self.rooms[room_id]
+        previous = room.get(user_id)
+        if previous:
+            previous.close(code=1000)
+            self._unindex(previous)
+
+        connection = Connection(websocket, room_id, user_id, codec=codec, topics=parse_topics(topics))
+        connection.start()
 
-        self.rooms[room_id][user_id] = websocket
-        print(f"{user_id} joined room {room_id} ({len(self.rooms[room_id])} users)")
+        missed = self._missed(connection, last_seq)
+        if missed is None:
+            # Late joiners (or a gap too large to replay) get the current values, only deltas after that
+            connection.send(Frame({
+                "type": "snapshot",
+                "room": room_id,
+                "seq": self.seq.get(room_id, 0),
+                "payload": {k: v for k, v in state.items() if connection.wants(topic_of_id(k))},
+            }))
+        else:
+            for frame in missed:
+                connection.send(frame)
 
-    def disconnect(self, websocket: WebSocket, room_id: str, user_id: str):
+        room[user_id] = connection
+        self._index(connection)
+        print(f"{user_id} joined room {room_id} ({len(room)} users)")
+
+    async def _open_room(self, room_id: str) -> bool:
+        """Creates the room and subscribes to it unless it exists, True when it had to."""
+        if room_id in self.rooms:
+            return False
+        self.rooms[room_id] = {}
+        eviction = self._evictions.pop(room_id, None)
+        if eviction:
+            eviction.cancel()
+        await self.broker.subscribe(room_id)
+        return True
+
+    async def disconnect(self, websocket: WebSocket, room_id: str, user_id: str):
         room = self.rooms.get(room_id)
         if not room:
             return
 
         # Only delete if this exact socket is the one stored
-        if user_id in room and room[user_id] is websocket:
+        connection = room.get(user_id)
+        if connection and connection.websocket is websocket:
+            connection.stop()
+            self._unindex(connection)
             del room[user_id]
             print(f"{user_id} left room {room_id}")
 
         # Cleanup if room is empty
         if not room:
             del self.rooms[room_id]
+            self.subscribers.pop(room_id, None)
+            # The values stay a while for a rejoin, the replay history can't: nothing reaches it while unsubscribed
+            self._evictions[room_id] = asyncio.get_running_loop().call_later(
+                WS_ROOM_STATE_TTL, self._evict_state, room_id,
+            )
+            self.seq.pop(room_id, None)
+            self.history.pop(room_id, None)
+            ticker = self.tickers.pop(room_id, None)
+            if ticker:
+                ticker.stop()
+            self.engine.clear_room(room_id)
+            await self.broker.unsubscribe(room_id)
             print(f"Room {room_id} deleted (no users left)")
 
+    def _index(self, connection: Connection):
+        index = self.subscribers.setdefault(connection.room_id, {})
+        for topic in connection.topics:
+            index.setdefault(topic, {})[connection.user_id] = connection
+
+    def _unindex(self, connection: Connection):
+        index = self.subscribers.get(connection.room_id, {})
+        for topic in connection.topics:
+            subscribers = index.get(topic)
+            if subscribers and subscribers.get(connection.user_id) is connection:
+                del subscribers[connection.user_id]
+                if not subscribers:
+                    del index[topic]
+
+    def _missed(self, connection: Connection, last_seq: Optional[int]) -> Optional[List[Frame]]:
+        """
+        The broadcasts a reconnecting client missed since last_seq, or None
+        when it needs a full resync because the ring buffer doesn't reach back that far.
+        """
+        if last_seq is None:
+            return None
+
+        room_id = connection.room_id
+        current = self.seq.get(room_id, 0)
+        if last_seq > current:
+            return None
+        if last_seq == current:
+            return []
+
+        history = self.history.get(room_id)
+        if not history or history[0][0] > last_seq + 1:
+            return None
+
+        # The client's own messages were never sent to it, don't replay them either
+        missed = []
+        for seq, frame in history:
+            if seq > last_seq and frame.data.get("from") != connection.user_id:
+                frame = self._frame_for(connection, frame, {})
+                if frame is not None:
+                    missed.append(frame)
+        return missed
+
+    def _frame_for(self, connection: Connection, frame: Frame, cache: Dict[FrozenSet[str], Optional[Frame]]) -> Optional[Frame]:
+        """
+        What of frame the connection gets, None when nothing. A batch mixing topics is cut
+        down to the connection's topics, one cut per topic set in cache so it's encoded once.
+        """
+        data = frame.data
+        if "topics" not in data:
+            return frame if connection.wants(data.get("topic")) else None
+        if ALL in connection.topics:
+            return frame
+
+        if connection.topics not in cache:
+            updates = [u for u in data["payload"] if connection.wants(u.get("topic") or topic_of_id(u.get("id")))]
+            part = None
+            if updates:
+                part = {key: value for key, value in data.items() if key not in ("payload", "topics")}
+                part["payload"] = updates
+            cache[connection.topics] = Frame(part) if part else None
+        return cache[connection.topics]
+
+    def _evict_state(self, room_id: str):
+        self._evictions.pop(room_id, None)
+        if room_id not in self.rooms:
+            self.state.pop(room_id, None)
+
+    async def _load_state(self, room_id: str, base: bool) -> Dict[str, Any]:
+        """The case's base values (when base is set), overlaid with the live values the broker holds."""
+        values = await load_base_values(room_id) if base else {}
+        values.update(await self.broker.snapshot(room_id))
+        return values
+
+    async def _room_state(self, room_id: str, refresh: bool = False) -> Dict[str, Any]:
+        """
+        The room's state, seeded from its simulation's case and the broker the first time
+        it's needed, and refreshed from the broker when this worker subscribes again.
+        """
+        if room_id not in self.state:
+            self.state[room_id] = {}
+            self._touched[room_id] = set()
+            self._seeding[room_id] = asyncio.create_task(self._load_state(room_id, base=True))
+        elif refresh and room_id not in self._seeding:
+            self._touched[room_id] = set()
+            self._seeding[room_id] = asyncio.create_task(self._load_state(room_id, base=False))
+
+        seeding = self._seeding.get(room_id)
+        if seeding:
+            loaded = await seeding
+            # Only the first one back merges, for everyone waiting on the same load
+            if self._seeding.get(room_id) is seeding:
+                del self._seeding[room_id]
+                touched = self._touched.pop(room_id, set())
+                state = self.state.get(room_id)
+                if state is not None:
+                    # Updates that arrived while loading are newer than what was loaded
+                    for key, value in loaded.items():
+                        if key not in touched:
+                            state[key] = value
+
+        return self.state.get(room_id, {})
+
     async def handle_message(self, room_id: str, user_id: str, message: Dict[str, Any]):
         """
-        Handle an incoming JSON object from a user in a room
-        and broadcast it to all other users in that same room.
+        Handle an incoming message from a user in a room
+        and publish it to all other users in that same room, on every worker.
 
         Expected client payload:
             {
               "type": "update",
               "payload": { "id": "pulse", "value": 97 }
             }
+
+        Or to let the server move a vital on its own:
+            {
+              "type": "trend",
+              "payload": { "id": "pulse", "to": 130, "duration": 300, "shape": "linear", "noise": 2 }
+            }
         """
         room = self.rooms.get(room_id)
         if not room:
             return
 
+        msg_type = message.get("type", "update")
+        payload = message.get("payload", message)
+        topic = topic_of(message, payload)
+
+        if msg_type == "trend" and isinstance(payload, dict):
+            self._set_trend(room_id, payload)
+
+        # Only real changes are broadcast
+        if msg_type == "update" and isinstance(payload, dict) and "id" in payload:
+            # A value set by hand takes over from a running trend
+            self.engine.stop_trend(room_id, payload["id"])
+
+            if self.tick_hz:
+                # Discrete events (alarms, notes, ...) skip this and go out right away
+                ticker = self.tickers.get(room_id)
+                if ticker is None:
+                    ticker = self.tickers[room_id] = RoomTicker(room_id, self.tick_hz, self.publish_updates)
+                ticker.add(user_id, payload, topic)
+                return
+
+            state = self.state.get(room_id, {})
+            if payload["id"] in state and state[payload["id"]] == payload.get("value"):
+                return
+
+        # Build the envelope once, every recipient gets the same encoded buffer
         broadcast_data = {
-            "type": message.get("type", "update"),
+            "type": msg_type,
             "from": user_id,
             "room": room_id,
-            "payload": message.get("payload", message),
+            "payload": payload,
         }
+        if topic is not None:
+            broadcast_data["topic"] = topic
 
-        await self.broadcast_to_room(room_id, broadcast_data, exclude_user_id=user_id)
+        await self._publish(room_id, user_id, broadcast_data)
+
+    async def _publish(self, room_id: str, user_id: str, data: Dict[str, Any]):
+        await self.broker.publish(room_id, {"origin": self.worker_id, "exclude": user_id, "data": data})
+
+    def _set_trend(self, room_id: str, payload: Dict[str, Any]):
+        vital_id = payload.get("id")
+        if not vital_id:
+            return
+        if payload.get("stop"):
+            self.engine.stop_trend(room_id, vital_id)
+            return
+
+        # The trend starts from the current value unless told otherwise
+        state = self.state.get(room_id, {})
+        try:
+            start = float(payload.get("from", state.get(vital_id)))
+            target = float(payload.get("to", start))
+            duration = float(payload.get("duration", 60))
+            noise = float(payload.get("noise", 0))
+            if not all(math.isfinite(x) for x in (start, target, duration, noise)):
+                raise ValueError("from, to, duration and noise must be finite numbers")
+            self.engine.set_trend(
+                room_id,
+                vital_id,
+                start=start,
+                target=target,
+                duration=duration,
+                shape=payload.get("shape", "linear"),
+                noise=noise,
+                decimals=min(max(int(payload.get("decimals", 0)), 0), MAX_TREND_DECIMALS),
+            )
+        except (TypeError, ValueError, OverflowError) as e:
+            print(f"Invalid trend for {vital_id} in room {room_id}: {e}")
+
+    async def _emit_trends(self, room_id: str, updates: List[Dict[str, Any]]):
+        if self.tick_hz and room_id in self.rooms:
+            # Joins the room's next tick, along with whatever the users sent
+            ticker = self.tickers.get(room_id)
+            if ticker is None:
+                ticker = self.tickers[room_id] = RoomTicker(room_id, self.tick_hz, self.publish_updates)
+            for update in updates:
+                ticker.add("engine", update)
+            return
+        await self.publish_updates(room_id, [("engine", update, None) for update in updates])
+
+    async def publish_updates(self, room_id: str, updates: List[Tuple[str, Dict[str, Any], Optional[str]]]):
+        """
+        Publishes (user_id, update, topic) triples, everything a ticker coalesced in a
+        room or a trend engine step, as one frame. The topic is the named channel the
+        update was sent to, None routes it by its id like an unticked update.
+        A batch from several senders names the sender on each update, one mixing
+        topics lists them in "topics" and every connection gets only the updates of
+        its topics (see _frame_for), an update sent to a named channel carries it.
+        """
+        state = self.state.get(room_id, {})
+        changed = [
+            (user_id, update, topic or topic_of_id(update["id"])) for user_id, update, topic in updates
+            if not (update["id"] in state and state[update["id"]] == update.get("value"))
+        ]
+        if not changed:
+            return
+
+        senders = {user_id for user_id, _, _ in changed}
+        topics = {topic for _, _, topic in changed}
+        sender = next(iter(senders)) if len(senders) == 1 else None
+
+        if len(topics) > 1:
+            # Only where the channel isn't the id's own prefix, _frame_for falls back to that
+            changed = [
+                (user_id, update if topic == topic_of_id(update["id"]) else {**update, "topic": topic}, topic)
+                for user_id, update, topic in changed
+            ]
+
+        # A lone update keeps the plain update shape
+        if len(changed) == 1:
+            data = {"type": "update", "from": sender, "room": room_id, "payload": changed[0][1]}
+        elif sender is not None:
+            data = {"type": "batch", "from": sender, "room": room_id, "payload": [update for _, update, _ in changed]}
+        else:
+            data = {"type": "batch", "room": room_id, "payload": [{**update, "from": user_id} for user_id, update, _ in changed]}
+
+        if len(topics) == 1:
+            topic = next(iter(topics))
+            if topic is not None:
+                data["topic"] = topic
+        else:
+            data["topics"] = sorted(topic for topic in topics if topic is not None)
+
+        # Every sender's own updates are left out for it only when there's a single one
+        await self._publish(room_id, sender, data)
+
+    async def _deliver(self, room_id: str, message: Dict[str, Any]):
+        """
+        Broker callback, stamps the room's seq on a published message, applies it to
+        the room state, records it, keeps it for resuming clients and fans it out to
+        this process' sockets.
+        """
+        data = message["data"]
+        seq = message.get("seq")
+        if seq is not None:
+            data["seq"] = seq
+            self.seq[room_id] = max(seq, self.seq.get(room_id, 0))
+        self._apply(room_id, data)
+
+        if message.get("origin") == self.worker_id:
+            self.recorder.record(room_id, data)
+
+        frame = Frame(data)
+        if seq is not None and room_id in self.rooms:
+            history = self.history.get(room_id)
+            if history is None:
+                history = self.history[room_id] = deque(maxlen=self.history_size)
+            history.append((seq, frame))
+
+        await self.broadcast_to_room(
+            room_id, frame, exclude_user_id=message.get("exclude"), topic=data.get("topic"),
+        )
+
+    def _apply(self, room_id: str, data: Dict[str, Any]):
+        state = self.state.get(room_id)
+        if state is None:
+            return
+
+        changes = state_changes(data)
+        state.update(changes)
+        touched = self._touched.get(room_id)
+        if touched is not None:
+            touched.update(changes)
 
     async def broadcast_to_room(
         self,
         room_id: str,
-        data: Dict[str, Any],
+        data: Union[Frame, Dict[str, Any]],
         exclude_user_id: Optional[str] = None,
+        topic: Optional[str] = None,
     ):
+        """
+        Enqueue the data on every local connection in the room subscribed to the topic
+        (all of them without one), never waits on a socket.
+        Each connection's writer task does the actual sending.
+        """
         room = self.rooms.get(room_id)
         if not room:
             return
 
-        for uid, ws in list(room.items()):
-            if exclude_user_id is not None and uid == exclude_user_id:
-                continue
+        frame = data if isinstance(data, Frame) else Frame(data)
 
-            try:
-                print("DATA: \n", data)
-                await ws.send_json(data)
-            except Exception as e:
-                print(f"Failed to send to {uid} in room {room_id}: {e}")
+        if "topics" in frame.data:
+            # Mixed topics, each connection gets its part
+            cache: Dict[FrozenSet[str], Optional[Frame]] = {}
+            for uid, connection in list(room.items()):
+                if exclude_user_id is not None and uid == exclude_user_id:
+                    continue
+                part = self._frame_for(connection, frame, cache)
+                if part is not None:
+                    connection.send(part)
+            return
+
+        if topic is None:
+            targets = [room]
+        else:
+            index = self.subscribers.get(room_id, {})
+            targets = [index.get(ALL, {}), index.get(topic, {})]
+
+        for subscribers in targets:
+            for uid, connection in list(subscribers.items()):
+                if exclude_user_id is not None and uid == exclude_user_id:
+                    continue
+
+                connection.send(frame)
 
 
 manager = RoomManager()
@@ -90,6 +492,9 @@ async def websocket_endpoint(
     websocket: WebSocket,
     token: str = Query(None),
     room: str = Query(None),
+    last_seq: Optional[int] = Query(None),
+    topics: Optional[str] = Query(None),
+    passphrase: Optional[str] = Query(None),
 ):
     print("Incoming WS handshake",
           "has_token=", bool(token),
@@ -113,11 +518,33 @@ async def websocket_endpoint(
         await websocket.close(code=1011)
         return
 
-    await manager.connect(websocket, room, user_id)
+    # The room has to be an active simulation, checked against the in-memory admission cache
+    try:
+        admitted = await admission_cache.admit(room, payload, passphrase)
+    except Exception as e:
+        print(f"WS admission check failed: {e}")
+        await websocket.close(code=1011)
+        return
+
+    if not admitted:
+        print(f"WS admission denied for user={user_id}, room={room}")
+        await websocket.close(code=1008)
+        return
+
+    await manager.connect(websocket, room, user_id, last_seq=last_seq, topics=topics)
 
     try:
         while True:
-            data = await websocket.receive_json()
+            try:
+                data = await receive(websocket)
+            except InvalidMessage as e:
+                # Dropped before it reaches the room, its history or the event log
+                print(f"Ignoring invalid message from user={user_id}, room={room}: {e}")
+                continue
             await manager.handle_message(room, user_id, data)
     except WebSocketDisconnect:
-        manager.disconnect(websocket, room, user_id)
\ No newline at end of file
+        pass
+    except Exception as e:
+        print(f"WS error for user={user_id}, room={room}: {e}")
+    finally:
+        await manager.disconnect(websocket, room, user_id)
\ No newline at end of file
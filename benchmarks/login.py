@@ -0,0 +1,89 @@
+"""
+Login throughput against concurrency, for tuning the Argon2 cost and the password
+pool (ARGON2_*, PASSWORD_WORKERS, PASSWORD_MAX_PENDING). For every concurrency
+level it fires that many clients at POST /users/login and, at the same time, pings
+GET / to show whether the event loop (and with it every websocket room) stays
+responsive while the logins run.
+
+Needs a running server and an existing user:
+    python benchmarks/login.py --url http://localhost:8080 --email a@b.fi --password secret
+Every request logs the same account in from one address, so start the server with the
+login limits off (RATE_LIMIT_LOGIN= RATE_LIMIT_LOGIN_IP=) or most of them get a 429.
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+LEVELS = [1, 4, 16, 64, 200]
+
+
+def _percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def _ping(url, stop, latencies):
+    session = requests.Session()
+    while not stop.is_set():
+        start = time.perf_counter()
+        session.get(url + "/")
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.05)
+
+
+def bench(url, email, password, clients, per_client):
+    def login(_):
+        session = requests.Session()
+        results = []
+        for _ in range(per_client):
+            start = time.perf_counter()
+            response = session.post(url + "/users/login", json={"email": email, "password": password})
+            results.append((response.status_code, time.perf_counter() - start))
+        return results
+
+    stop = threading.Event()
+    pings = []
+    pinger = threading.Thread(target=_ping, args=(url, stop, pings))
+    pinger.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = [r for batch in pool.map(login, range(clients)) for r in batch]
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    pinger.join()
+
+    ok = [latency for code, latency in results if code == 200]
+    busy = sum(1 for code, _ in results if code == 503)
+    return {
+        "ok_per_s": len(ok) / elapsed,
+        "p50": statistics.median(ok) if ok else float("nan"),
+        "p95": _percentile(ok, 0.95),
+        "busy": busy,
+        "other": len(results) - len(ok) - busy,
+        "ping_p95": _percentile(pings, 0.95),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--email", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--per-client", type=int, default=3, help="logins per client")
+    args = parser.parse_args()
+
+    print(f"{'clients':>8} {'ok/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'503':>6} {'other':>6} {'GET / p95 ms':>13}")
+    for clients in LEVELS:
+        r = bench(args.url.rstrip("/"), args.email, args.password, clients, args.per_client)
+        print(
+            f"{clients:>8} {r['ok_per_s']:>8.1f} {r['p50'] * 1000:>8.0f} {r['p95'] * 1000:>8.0f}"
+            f" {r['busy']:>6} {r['other']:>6} {r['ping_p95'] * 1000:>13.1f}"
+        )
@@ -0,0 +1,56 @@
+"""
+Micro-benchmark for the server side trend engine: ticks per second against the
+number of rooms, every room trending 6 vitals with noise.
+
+Run from the repository root:
+    python benchmarks/trend_engine.py
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from websocket.trends import TrendEngine  # noqa: E402
+
+VITALS = ["pulse", "spo2", "resp_rate", "temp", "bp_sys", "bp_dia"]
+ROOM_COUNTS = [1, 10, 100, 500, 1000, 5000]
+
+
+async def _emit(room_id, updates):
+    pass
+
+
+def bench(rooms: int, seconds: float = 1.0) -> float:
+    engine = TrendEngine(_emit, seed=1)
+    # set_trend would start the engine's own task, the benchmark steps it by hand instead
+    engine._task = _NeverDone()
+    for room in range(rooms):
+        for i, vital in enumerate(VITALS):
+            engine.set_trend(
+                str(room), vital,
+                start=80, target=130, duration=10 ** 9,
+                shape="exp" if i % 2 else "linear",
+                noise=1.5, decimals=i % 2,
+            )
+
+    ticks = 0
+    now = time.monotonic()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        now += engine.interval
+        engine.step(now)
+        ticks += 1
+    return ticks / seconds
+
+
+class _NeverDone:
+    def done(self):
+        return False
+
+
+if __name__ == "__main__":
+    print(f"{'rooms':>8} {'vitals':>8} {'ticks/s':>10} {'ms/tick':>9}")
+    for rooms in ROOM_COUNTS:
+        rate = bench(rooms)
+        print(f"{rooms:>8} {rooms * len(VITALS):>8} {rate:>10.0f} {1000 / rate:>9.3f}")